@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Compares how many bytes an upload has to send after typical edits of a
+   file when it is cut into fixed-size parts and when it is cut into
+   content-defined parts. The server is assumed to hold every part of the
+   original file, as has_parts would report it. Results are printed as
+   JSON."""
+
+from sys import argv, path
+
+import os
+import argparse
+import hashlib
+import json
+import time
+from cStringIO import StringIO
+
+path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from copyfuse import FixedChunker, ContentChunker
+
+def fingerprints(chunker, data):
+    parts = {}
+    for offset, part_data in chunker.chunks(StringIO(data), 0, len(data)):
+        parts[hashlib.md5(part_data).hexdigest() + hashlib.sha1(part_data).hexdigest() + '-' + str(len(part_data))] = len(part_data)
+    return parts
+
+def edits(data):
+    third = len(data) // 3
+    return [
+        ('insert', data[:third] + os.urandom(100) + data[third:]),
+        ('delete', data[:third] + data[third + 100:]),
+        ('overwrite', data[:third] + os.urandom(100) + data[third + 100:]),
+        ('prepend', os.urandom(100) + data),
+        ('append', data + os.urandom(1048576))]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare bytes sent by fixed and content-defined chunking')
+
+    parser.add_argument(
+        '--size', type=int, default=32,
+        help='size of the original file in MiB')
+    parser.add_argument(
+        '--chunk-sizes', default='256,1024,4096', metavar='MIN,AVG,MAX',
+        help='minimum, average and maximum part size in KiB for content-defined chunking')
+
+    args = parser.parse_args(argv[1:])
+
+    data = os.urandom(args.size * 1048576)
+    chunkers = [
+        ('fixed', FixedChunker()),
+        ('cdc', ContentChunker(*[int(size) * 1024 for size in args.chunk_sizes.split(',')]))]
+
+    results = []
+    for name, chunker in chunkers:
+        stored = fingerprints(chunker, data)
+        for edit, edited in edits(data):
+            start = time.time()
+            parts = fingerprints(chunker, edited)
+            results.append({
+                'chunking': name,
+                'edit': edit,
+                'file_bytes': len(edited),
+                'parts': len(parts),
+                'bytes_sent': sum(size for key, size in parts.items() if key not in stored),
+                'chunking_seconds': round(time.time() - start, 3)})
+
+    print json.dumps(results, indent=2)
+
+if __name__ == "__main__":
+    main()
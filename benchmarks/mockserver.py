@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""A local stand-in for the Copy API, good enough to benchmark copyfuse
+   against. It keeps the whole tree and every part in memory and answers
+   /auth_user, /list_objects (paged, with parts on request),
+   /download_object, /has_parts, /send_parts, /get_parts and
+   /update_objects. Every request can be delayed by a fixed latency, and
+   bodies are throttled to a bandwidth shared by all connections.
+
+   Run it on its own to mount against it:
+
+       benchmarks/mockserver.py --port 8080 --latency 0.05
+       ./copyfuse.py --api-url http://127.0.0.1:8080 user pass /mnt/copy
+"""
+
+from __future__ import with_statement
+
+from threading import Lock, Thread
+from sys import argv
+
+import os
+import argparse
+import hashlib
+import json
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+def fingerprint(data):
+    return hashlib.md5(data).hexdigest() + hashlib.sha1(data).hexdigest()
+
+class MockStore:
+    """The tree of objects by path, the parts by key and counters of the
+       requests and bytes the server has seen."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.objects = {'/': {'type': 'dir', 'ctime': int(time.time()), 'mtime': None}}
+        self.parts = {}
+        self.counters = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset_counters(self):
+        with self.lock:
+            counters = self.counters
+            self.counters = {}
+        return counters
+
+    def put_dir(self, path):
+        with self.lock:
+            self.objects[path] = {'type': 'dir', 'ctime': int(time.time()), 'mtime': None}
+
+    def put_file(self, path, data, part_size=1048576):
+        parts = []
+        with self.lock:
+            for offset in range(0, len(data), part_size):
+                part_data = data[offset:offset + part_size]
+                key = fingerprint(part_data) + '-' + str(len(part_data))
+                self.parts[key] = part_data
+                parts.append({'fingerprint': fingerprint(part_data), 'offset': offset, 'size': len(part_data)})
+            self.objects[path] = {'type': 'file', 'size': len(data), 'ctime': int(time.time()), 'mtime': int(time.time()), 'parts': parts}
+
+    def file_data(self, path):
+        with self.lock:
+            return ''.join(self.parts[part['fingerprint'] + '-' + str(part['size'])] for part in self.objects[path]['parts'])
+
+    def describe(self, path, include_parts=False):
+        entry = self.objects[path]
+        child = {'path': path, 'type': entry['type'], 'size': entry.get('size', 0),
+                 'created_time': entry['ctime'], 'modified_time': entry['mtime']}
+        if include_parts and entry['type'] == 'file':
+            child['revisions'] = [{'parts': entry['parts']}]
+        return child
+
+    def children(self, path):
+        with self.lock:
+            paths = sorted(child for child in self.objects if child != '/' and os.path.dirname(child) == path)
+            return [self.describe(child) for child in paths]
+
+    def apply(self, action):
+        """Applies one update_objects action and tells whether it worked."""
+        with self.lock:
+            path = action['path']
+            if action['action'] == 'create' and action['object_type'] == 'dir':
+                self.objects[path] = {'type': 'dir', 'ctime': int(time.time()), 'mtime': None}
+            elif action['action'] == 'create':
+                parts = action['parts']
+                if isinstance(parts, dict):
+                    parts = [parts[i] for i in sorted(parts, key=int)]
+                parts = [{'fingerprint': part['fingerprint'], 'offset': int(part['offset']), 'size': int(part['size'])} for part in parts]
+                for part in parts:
+                    if part['fingerprint'] + '-' + str(part['size']) not in self.parts:
+                        return False
+                self.objects[path] = {'type': 'file', 'size': int(action['size']), 'ctime': int(time.time()), 'mtime': int(time.time()), 'parts': parts}
+            elif action['action'] in ('remove', 'rename'):
+                moved = [child for child in self.objects if child == path or child.startswith(path + '/')]
+                if not moved:
+                    return False
+                for child in moved:
+                    entry = self.objects.pop(child)
+                    if action['action'] == 'rename':
+                        self.objects[action['new_path'] + child[len(path):]] = entry
+            else:
+                return False
+            return True
+
+class Throttle:
+    """Paces transfers to a number of bytes per second shared by all
+       connections; 0 means unlimited."""
+
+    def __init__(self, bandwidth=0):
+        self.bandwidth = bandwidth
+        self.lock = Lock()
+        self.free_at = 0
+
+    def transfer(self, size):
+        if not self.bandwidth or not size:
+            return
+        with self.lock:
+            start = max(time.time(), self.free_at)
+            self.free_at = start + float(size) / self.bandwidth
+            done = self.free_at
+        time.sleep(max(done - time.time(), 0))
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one go, or Nagle and delayed acks add ~40ms to
+    # every request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body, code=200):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.server.throttle.transfer(len(body))
+        self.server.store.count('bytes_out', len(body))
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        store = self.server.store
+        time.sleep(self.server.latency)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.throttle.transfer(len(body))
+        method = self.path.strip('/')
+        store.count(method)
+        store.count('bytes_in', len(body))
+
+        parts = []
+        for i in range(1, int(self.headers.get('X-Part-Count', 0)) + 1):
+            parts.append((self.headers['X-Part-Fingerprint-' + str(i)], int(self.headers['X-Part-Size-' + str(i)])))
+
+        if method == 'has_parts':
+            missing = [{'fingerprint': part[0], 'size': str(part[1])} for part in parts if part[0] + '-' + str(part[1]) not in store.parts]
+            return self.reply({'send_parts': missing})
+        if method == 'send_parts':
+            offset = 0
+            for part_fingerprint, size in parts:
+                part_data = body[offset:offset + size]
+                offset += size
+                if fingerprint(part_data) != part_fingerprint:
+                    return self.reply({'result': 'error', 'message': 'fingerprint mismatch'})
+                with store.lock:
+                    store.parts[part_fingerprint + '-' + str(size)] = part_data
+            return self.reply({'result': 'success'})
+        if method == 'get_parts':
+            with store.lock:
+                payload = ''.join(store.parts[part[0] + '-' + str(part[1])] for part in parts)
+            return self.reply(payload)
+
+        data = json.loads(urlparse.parse_qs(body)['data'][0])
+        if method == 'auth_user':
+            return self.reply({'auth_token': 'mock-token'})
+        if method == 'list_objects':
+            path = data['path']
+            if path not in store.objects:
+                return self.reply({'result': 'error', 'error': 'not found'})
+            children = store.children(path) if store.objects[path]['type'] == 'dir' else []
+            watermark = int(data.get('list_watermark', 0))
+            max_items = int(data.get('max_items', len(children) or 1))
+            with store.lock:
+                described = store.describe(path, data.get('include_parts', False))
+            return self.reply({'object': described, 'children': children[watermark:watermark + max_items],
+                               'more_items': watermark + max_items < len(children)})
+        if method == 'download_object':
+            return self.reply(store.file_data(data['path']))
+        if method == 'update_objects':
+            results = []
+            for i in sorted(data['meta'], key=int):
+                results.append({'result': 'success' if store.apply(data['meta'][i]) else 'error'})
+            result = 'success' if all(entry['result'] == 'success' for entry in results) else 'error'
+            return self.reply({'result': result, 'objects': results})
+        self.reply({'result': 'error', 'error': 'unknown method'}, 404)
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0, bandwidth=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+        self.store = MockStore()
+        self.latency = latency
+        self.throttle = Throttle(bandwidth)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1])
+
+    def start(self):
+        """Serves requests on a background thread."""
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the Copy API')
+
+    parser.add_argument(
+        '--port', type=int, default=8080,
+        help='port to listen on (on 127.0.0.1)')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='seconds every request is delayed by')
+    parser.add_argument(
+        '--bandwidth', type=float, default=0,
+        help='MiB per second shared by all transfers (0 for no limit)')
+
+    args = parser.parse_args(argv[1:])
+
+    server = MockServer(args.port, args.latency, int(args.bandwidth * 1048576))
+    print 'serving on ' + server.url
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+
+"""Runs copyfuse through a set of workloads against the local mock server
+   and prints the timings, throughput and the requests the server saw as
+   JSON, one entry per scenario.
+
+   With --mode direct the CopyFUSE operations are called in-process, which
+   measures copyfuse alone. With --mode mount copyfuse.py is started on a
+   temporary mount point and the workloads go through the kernel, which
+   needs a working FUSE setup."""
+
+from __future__ import with_statement
+
+from threading import Lock, Thread
+from sys import argv, executable, path
+
+import os
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+path.insert(0, os.path.join(here, '..'))
+
+from mockserver import MockServer
+
+MiB = 1048576
+
+class DirectDriver:
+    """Drives a CopyFUSE instance in this process."""
+
+    def __init__(self, server, args):
+        from copyfuse import CopyFUSE
+        self.fs = CopyFUSE('bench@example.com', 'bench', api_url=server.url, readahead=args.readahead * MiB, writeback=args.writeback)
+        self.fs('init', '/')
+
+    def close(self):
+        self.fs('destroy', '/')
+
+    def counters(self):
+        return self.fs.metrics.snapshot()['counters']
+
+    def stat(self, path):
+        return self.fs('getattr', path)['st_size']
+
+    def listdir(self, path):
+        return [item[0] for item in self.fs('readdir', path, 0, 0) if item[0] not in ('.', '..')]
+
+    def mkdir(self, path):
+        self.fs('mkdir', path, 0755)
+
+    def read(self, path, chunk):
+        fh = self.fs('open', path, os.O_RDONLY)
+        size = 0
+        while True:
+            data = self.fs('read', path, chunk, size, fh)
+            size += len(data)
+            if len(data) < chunk:
+                break
+        self.fs('release', path, fh)
+        return size
+
+    def read_interleaved(self, path, chunk, threads):
+        fh = self.fs('open', path, os.O_RDONLY)
+        claim = ChunkClaimer(chunk)
+
+        def reader():
+            while True:
+                offset = claim.next()
+                data = self.fs('read', path, chunk, offset, fh)
+                claim.add(len(data))
+                if len(data) < chunk:
+                    break
+
+        run_threads(reader, threads)
+        self.fs('release', path, fh)
+        return claim.size
+
+    def write(self, path, data, chunk):
+        fh = self.fs('create', path, 0644)
+        for offset in range(0, len(data), chunk):
+            self.fs('write', path, data[offset:offset + chunk], offset, fh)
+        self.fs('fsync', path, 0, fh)
+        self.fs('release', path, fh)
+
+    def edit(self, path, offset, data):
+        fh = self.fs('open', path, os.O_RDWR)
+        self.fs('write', path, data, offset, fh)
+        self.fs('fsync', path, 0, fh)
+        self.fs('release', path, fh)
+
+class MountDriver:
+    """Mounts copyfuse.py on a temporary directory and drives it through
+       the file system."""
+
+    def __init__(self, server, args):
+        self.work = tempfile.mkdtemp(prefix='copyfuse-bench-')
+        self.mount_point = os.path.join(self.work, 'mnt')
+        os.mkdir(self.mount_point)
+        command = [executable, os.path.join(here, '..', 'copyfuse.py'), '-f',
+                   '--api-url', server.url, '--metadata-db', 'none', '--cache-size', '0',
+                   '--staging-dir', os.path.join(self.work, 'staging'), '--readahead', str(args.readahead)]
+        if args.writeback:
+            command.append('--writeback')
+        command += (args.copyfuse_args or '').split()
+        command += ['bench@example.com', 'bench', self.mount_point]
+        self.process = subprocess.Popen(command)
+        deadline = time.time() + 10
+        while not os.path.ismount(self.mount_point):
+            if self.process.poll() is not None or time.time() > deadline:
+                raise RuntimeError('copyfuse did not mount')
+            time.sleep(0.1)
+
+    def close(self):
+        if subprocess.call(['fusermount', '-u', self.mount_point]) != 0:
+            subprocess.call(['umount', self.mount_point])
+        self.process.wait()
+        shutil.rmtree(self.work, True)
+
+    def local(self, path):
+        return self.mount_point + path
+
+    def counters(self):
+        with open(self.local('/.copyfuse/stats')) as f:
+            return json.load(f)['counters']
+
+    def stat(self, path):
+        return os.stat(self.local(path)).st_size
+
+    def listdir(self, path):
+        return os.listdir(self.local(path))
+
+    def mkdir(self, path):
+        os.mkdir(self.local(path))
+
+    def read(self, path, chunk):
+        size = 0
+        with open(self.local(path), 'rb') as f:
+            while True:
+                data = f.read(chunk)
+                if not data:
+                    break
+                size += len(data)
+        return size
+
+    def read_interleaved(self, path, chunk, threads):
+        claim = ChunkClaimer(chunk)
+
+        def reader():
+            with open(self.local(path), 'rb', 0) as f:
+                while True:
+                    offset = claim.next()
+                    f.seek(offset)
+                    data = f.read(chunk)
+                    claim.add(len(data))
+                    if len(data) < chunk:
+                        break
+
+        run_threads(reader, threads)
+        return claim.size
+
+    def write(self, path, data, chunk):
+        with open(self.local(path), 'wb') as f:
+            for offset in range(0, len(data), chunk):
+                f.write(data[offset:offset + chunk])
+            f.flush()
+            os.fsync(f.fileno())
+
+    def edit(self, path, offset, data):
+        with open(self.local(path), 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+class ChunkClaimer:
+    """Hands out consecutive chunk offsets to reader threads and adds up
+       what they read."""
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.lock = Lock()
+        self.offset = 0
+        self.size = 0
+
+    def next(self):
+        with self.lock:
+            offset = self.offset
+            self.offset += self.chunk
+            return offset
+
+    def add(self, size):
+        with self.lock:
+            self.size += size
+
+def run_threads(target, count):
+    threads = [Thread(target=target) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def readahead_counters(driver):
+    counters = driver.counters()
+    return {'readahead_prefetches': counters.get('readahead_prefetches', 0),
+            'readahead_resets': counters.get('readahead_resets', 0)}
+
+def metadata_storm(driver, store, args):
+    """Many threads listing a large directory and stating every entry."""
+    store.put_dir('/storm')
+    for i in range(args.files):
+        store.put_file('/storm/file%06d' % i, '')
+    store.reset_counters()
+
+    def storm(first):
+        driver.listdir('/storm')
+        for i in range(first, args.files, args.threads):
+            driver.stat('/storm/file%06d' % i)
+
+    start = time.time()
+    threads = [Thread(target=storm, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    operations = args.files + args.threads
+    return {'seconds': seconds, 'operations': operations, 'operations_per_second': operations / seconds}
+
+def sequential_read(driver, store, args):
+    """Reading a large file from start to end."""
+    store.put_file('/read.bin', os.urandom(args.size * MiB))
+    store.reset_counters()
+    start = time.time()
+    size = driver.read('/read.bin', args.chunk * 1024)
+    seconds = time.time() - start
+    result = {'seconds': seconds, 'bytes': size, 'mib_per_second': size / MiB / seconds}
+    result.update(readahead_counters(driver))
+    return result
+
+def interleaved_read(driver, store, args):
+    """Reading a large file front to back from several threads taking the
+       next chunk in turn, so reads arrive slightly out of order the way
+       the kernel's concurrent readahead requests do on a mount."""
+    store.put_file('/interleaved.bin', os.urandom(args.size * MiB))
+    store.reset_counters()
+    start = time.time()
+    size = driver.read_interleaved('/interleaved.bin', args.chunk * 1024, args.read_threads)
+    seconds = time.time() - start
+    result = {'seconds': seconds, 'bytes': size, 'mib_per_second': size / MiB / seconds}
+    result.update(readahead_counters(driver))
+    return result
+
+def sequential_write(driver, store, args):
+    """Writing a large new file from start to end and syncing it."""
+    data = os.urandom(args.size * MiB)
+    store.reset_counters()
+    start = time.time()
+    driver.write('/write.bin', data, args.chunk * 1024)
+    seconds = time.time() - start
+    return {'seconds': seconds, 'bytes': len(data), 'mib_per_second': len(data) / MiB / seconds}
+
+def small_files(driver, store, args):
+    """Creating many small files in a new directory."""
+    data = os.urandom(4096)
+    store.reset_counters()
+    start = time.time()
+    driver.mkdir('/small')
+    for i in range(args.small_files):
+        driver.write('/small/file%06d' % i, data, 4096)
+    seconds = time.time() - start
+    return {'seconds': seconds, 'files': args.small_files, 'files_per_second': args.small_files / seconds}
+
+def edit_reupload(driver, store, args):
+    """Changing a few bytes in the middle of a large file and syncing it,
+       which should only send the changed parts."""
+    store.put_file('/edit.bin', os.urandom(args.size * MiB))
+    driver.stat('/edit.bin')
+    store.reset_counters()
+    start = time.time()
+    driver.edit('/edit.bin', args.size * MiB // 2, os.urandom(4096))
+    seconds = time.time() - start
+    return {'seconds': seconds, 'file_bytes': args.size * MiB}
+
+SCENARIOS = [
+    ('metadata_storm', metadata_storm),
+    ('sequential_read', sequential_read),
+    ('interleaved_read', interleaved_read),
+    ('sequential_write', sequential_write),
+    ('small_files', small_files),
+    ('edit_reupload', edit_reupload)]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark copyfuse against a local mock of the Copy API')
+
+    parser.add_argument(
+        '--mode', choices=('direct', 'mount'), default='direct',
+        help='call the operations in-process or go through a real FUSE mount')
+    parser.add_argument(
+        '--scenarios', default=','.join(name for name, scenario in SCENARIOS),
+        help='comma separated scenarios to run (default: all)')
+    parser.add_argument(
+        '--latency', type=float, default=0.02,
+        help='seconds every request to the mock server is delayed by')
+    parser.add_argument(
+        '--bandwidth', type=float, default=0,
+        help='MiB per second of the mock server (0 for no limit)')
+    parser.add_argument(
+        '--size', type=int, default=32,
+        help='size of the large files in MiB')
+    parser.add_argument(
+        '--chunk', type=int, default=128,
+        help='size of each read and write in KiB')
+    parser.add_argument(
+        '--files', type=int, default=2000,
+        help='entries in the directory of the metadata storm')
+    parser.add_argument(
+        '--threads', type=int, default=16,
+        help='threads of the metadata storm')
+    parser.add_argument(
+        '--read-threads', type=int, default=4,
+        help='threads of the interleaved read')
+    parser.add_argument(
+        '--small-files', type=int, default=200,
+        help='files created by the small files scenario')
+    parser.add_argument(
+        '--readahead', type=int, default=32,
+        help='read-ahead window in MiB')
+    parser.add_argument(
+        '--writeback', default=False, action='store_true',
+        help='upload in the background')
+    parser.add_argument(
+        '--copyfuse-args',
+        help='extra arguments for copyfuse.py in mount mode')
+    parser.add_argument(
+        '--output',
+        help='write the results to this file instead of stdout')
+
+    args = parser.parse_args(argv[1:])
+
+    selected = args.scenarios.split(',')
+    unknown = set(selected) - set(name for name, scenario in SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: ' + ', '.join(sorted(unknown)))
+
+    results = []
+    for name, scenario in SCENARIOS:
+        if name not in selected:
+            continue
+        # a fresh server and mount per scenario, so caches do not carry over
+        server = MockServer(0, args.latency, int(args.bandwidth * MiB)).start()
+        if args.mode == 'direct':
+            driver = DirectDriver(server, args)
+        else:
+            driver = MountDriver(server, args)
+        try:
+            result = scenario(driver, server.store, args)
+        finally:
+            driver.close()
+            server.shutdown()
+            server.server_close()
+        result = dict((key, round(value, 3) if isinstance(value, float) else value) for key, value in result.items())
+        result['scenario'] = name
+        result['mode'] = args.mode
+        result['requests'] = server.store.reset_counters()
+        results.append(result)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,19 @@
 
 from __future__ import with_statement
 
-from errno import EACCES, ENOENT, EIO, EPERM
-from threading import Lock
+from errno import EACCES, EINVAL, ENOENT, EIO, ENOSPC, EPERM, errorcode
+from threading import Lock, Semaphore, Event, Condition, Thread
+from thread import get_ident
+from collections import OrderedDict, deque
+from itertools import count
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from multiprocessing.pool import ThreadPool
 from stat import S_IFDIR, S_IFREG
+from ctypes import CDLL, addressof, c_char, c_int, c_int64, memmove, string_at
+from ctypes.util import find_library
 from sys import argv, exit, stderr
+from platform import system
 
 import os
 import argparse
@@ -13,18 +22,1043 @@ import tempfile
 import time
 import json
 import hashlib
+import math
+import sqlite3
+import mmap
+import fcntl
+import shutil
 import urllib3
 
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
+from fuse import FUSE, FuseOSError, Operations, fuse_get_context
+
+API_URL = "https://next-api.copy.com"
+PART_SIZE = 1048576
+
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+
+try:
+    punch_hole = CDLL(find_library('c'), use_errno=True).fallocate64
+    punch_hole.argtypes = (c_int, c_int, c_int64, c_int64)
+except AttributeError:
+    # not Linux, evicted data keeps its disk space until the file is closed
+    punch_hole = None
+
+def mark_range(ranges, start, end):
+    """Adds [start, end) to a sorted list of disjoint (start, end) ranges,
+       merging it with the ranges it overlaps or touches."""
+    i = bisect_left(ranges, (start, start))
+    if i > 0 and ranges[i - 1][1] >= start:
+        i -= 1
+    j = i
+    while j < len(ranges) and ranges[j][0] <= end:
+        start = min(start, ranges[j][0])
+        end = max(end, ranges[j][1])
+        j += 1
+    ranges[i:j] = [(start, end)]
+
+def range_overlaps(ranges, start, end):
+    """Tells whether any of the sorted ranges overlaps [start, end)."""
+    i = bisect_left(ranges, (end, end))
+    return i > 0 and ranges[i - 1][1] > start
+
+def unmark_range(ranges, start, end):
+    """Removes [start, end) from the sorted ranges and returns how many
+       bytes they lost."""
+    i = bisect_left(ranges, (start, start))
+    if i > 0 and ranges[i - 1][1] > start:
+        i -= 1
+    j = i
+    kept = []
+    removed = 0
+    while j < len(ranges) and ranges[j][0] < end:
+        removed += min(end, ranges[j][1]) - max(start, ranges[j][0])
+        if ranges[j][0] < start:
+            kept.append((ranges[j][0], start))
+        if ranges[j][1] > end:
+            kept.append((end, ranges[j][1]))
+        j += 1
+    ranges[i:j] = kept
+    return removed
+
+def range_uncovered(ranges, start, end):
+    """Returns how many bytes of [start, end) the sorted ranges leave out."""
+    i = bisect_left(ranges, (start, start))
+    if i > 0 and ranges[i - 1][1] > start:
+        i -= 1
+    missing = end - start
+    while i < len(ranges) and ranges[i][0] < end:
+        missing -= min(end, ranges[i][1]) - max(start, ranges[i][0])
+        i += 1
+    return missing
+
+class FixedChunker:
+    """Cuts data into parts of PART_SIZE bytes."""
+
+    def chunks(self, f, offset, length):
+        """Yields (offset, data) for the parts of [offset, offset + length)
+           of f."""
+        f.seek(offset)
+        end = offset + length
+        while offset < end:
+            # obtain the part data
+            part_data = f.read(min(PART_SIZE, end - offset))
+            if part_data == '':
+                # print str(end) + " != " + str(offset)
+                raise FuseOSError(EIO)
+            yield offset, part_data
+            offset += len(part_data)
+
+class ContentChunker:
+    """Cuts data where a gear rolling hash over the last bytes matches a
+       mask, so part boundaries move along with inserted or removed data
+       instead of shifting every later part. Parts are at least min_size
+       and at most max_size bytes, and about avg_size on average. Hashing
+       runs byte by byte in Python, so this is considerably slower than
+       FixedChunker."""
+    # a fixed table, so that every client cuts the same data the same way
+    gear = [int(hashlib.md5(chr(i)).hexdigest()[:8], 16) for i in range(256)]
+
+    def __init__(self, min_size, avg_size, max_size):
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        # the hash shifts left, so the top bits depend on the most bytes
+        bits = max(int(round(math.log(max(avg_size - min_size, 2), 2))), 1)
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+
+    def cut(self, data):
+        """Returns the length of the first part of data."""
+        if len(data) <= self.min_size:
+            return len(data)
+        limit = min(len(data), self.max_size)
+        gear = self.gear
+        mask = self.mask
+        h = 0
+        for i, byte in enumerate(bytearray(buffer(data, self.min_size, limit - self.min_size))):
+            h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+            if not h & mask:
+                return self.min_size + i + 1
+        return limit
+
+    def chunks(self, f, offset, length):
+        """Yields (offset, data) for the parts of [offset, offset + length)
+           of f. The last part ends at offset + length."""
+        f.seek(offset)
+        remaining = length
+        data = ''
+        while True:
+            while len(data) < self.max_size and remaining > 0:
+                read = f.read(min(self.max_size, remaining))
+                if read == '':
+                    raise FuseOSError(EIO)
+                remaining -= len(read)
+                data += read
+            if data == '':
+                return
+            size = self.cut(data)
+            yield offset, data[:size]
+            data = data[size:]
+            offset += size
+
+class PartReader:
+    """File-like request body that reads the given parts of a file one
+       block at a time, so a send_parts upload never holds more than a block
+       of the file in memory."""
+    blocksize = 65536
+
+    def __init__(self, path, parts):
+        self.path = path
+        self.parts = parts
+        self.f = None
+        self.seek(0)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        # only rewinding is supported (urllib3 rewinds the body on retries)
+        if pos != 0 or whence != os.SEEK_SET:
+            raise IOError(EIO, 'PartReader can only be rewound')
+        self.index = 0
+        self.remaining = self.parts[0]['size'] if len(self.parts) else 0
+        self.position = 0
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size < 0 or size > self.blocksize:
+            size = self.blocksize
+        while self.remaining == 0:
+            self.index += 1
+            if self.index >= len(self.parts):
+                return ''
+            self.remaining = self.parts[self.index]['size']
+        if self.f is None:
+            self.f = open(self.path, 'rb')
+        part = self.parts[self.index]
+        self.f.seek(part['offset'] + part['size'] - self.remaining)
+        data = self.f.read(min(size, self.remaining))
+        if data == '':
+            # the file was truncated underneath us
+            raise IOError(EIO, 'short read from ' + self.path)
+        self.remaining -= len(data)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+class BlockCache:
+    """Persistent store of part data keyed by part fingerprint and size.
+
+       Every block is a file named after its key, written to a temporary
+       name and renamed into place, so the directory itself is the index and
+       a crash can at worst lose the block being written. Recency is kept in
+       the file mtimes, which lets the LRU order survive remounts. Blocks
+       shared by several files are stored once."""
+
+    def __init__(self, path, budget):
+        self.path = path
+        self.budget = budget
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.used = 0
+        self.load()
+
+    def load(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        found = []
+        for shard in os.listdir(self.path):
+            shard_path = os.path.join(self.path, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for name in os.listdir(shard_path):
+                block_path = os.path.join(shard_path, name)
+                st = os.stat(block_path)
+                # drop unfinished writes and blocks that are not as long as
+                # their key says
+                if name.endswith('.tmp') or st.st_size != int(name.rsplit('-', 1)[-1]):
+                    os.unlink(block_path)
+                    continue
+                found.append((st.st_mtime, name, st.st_size))
+        found.sort()
+        for mtime, key, size in found:
+            self.entries[key] = size
+            self.used += size
+        self.evict()
+
+    def block_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries[key] = self.entries.pop(key)
+        try:
+            with open(self.block_path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self.block_path(key), None)
+        except (IOError, OSError):
+            self.discard(key)
+            return None
+        return data
+
+    def put(self, key, data):
+        with self.lock:
+            if key in self.entries:
+                return
+        block_path = self.block_path(key)
+        if not os.path.isdir(os.path.dirname(block_path)):
+            try:
+                os.makedirs(os.path.dirname(block_path))
+            except OSError:
+                pass
+        tmp_path = '%s.%d.tmp' % (block_path, get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, block_path)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = len(data)
+                self.used += len(data)
+            self.evict()
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.used -= self.entries.pop(key)
+        try:
+            os.unlink(self.block_path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        while self.used > self.budget and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.used -= size
+            try:
+                os.unlink(self.block_path(key))
+            except OSError:
+                pass
+
+class StagingStore:
+    """Directory of the sparse staging files that hold open files.
+
+       Every mount keeps its files in a mount-* directory of its own under
+       path, locked for as long as the mount runs, so mounts can share path.
+       Files are deleted when they are closed; on startup the directories of
+       mounts that are gone are reclaimed. budget caps the bytes written into
+       staging files at once (0 for no limit); writes past it fail with
+       ENOSPC. Data fetched from the server does not count against it, but
+       once it and the written data pass the budget, fetched parts are
+       evicted again."""
+
+    def __init__(self, path=None, budget=0):
+        # without a directory of its own the store uses a temporary one
+        self.temporary = path is None
+        if self.temporary:
+            path = tempfile.mkdtemp(prefix='copyfuse-')
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+        self.root = path
+        self.budget = budget
+        self.lock = Lock()
+        self.used = 0
+        self.held = 0
+        self.path = tempfile.mkdtemp(prefix='mount-', dir=self.root)
+        # an flock is shared with the process fuse forks into, and goes
+        # away with it however it exits
+        self.owner = open(os.path.join(self.path, 'lock'), 'w')
+        fcntl.flock(self.owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            if name.startswith('mount-') and directory != self.path:
+                self.reclaim(directory)
+
+    def reclaim(self, directory):
+        """Deletes the staging files of a mount that is gone."""
+        try:
+            owner = open(os.path.join(directory, 'lock'), 'r')
+        except IOError:
+            # not a mount directory, or one still being set up
+            return
+        try:
+            try:
+                fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # its mount is still running
+                return
+            self.remove(directory)
+        finally:
+            owner.close()
+
+    def remove(self, directory):
+        for name in os.listdir(directory):
+            if name.startswith('staging-'):
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except OSError:
+                    pass
+        try:
+            os.unlink(os.path.join(directory, 'lock'))
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+    def close(self):
+        self.remove(self.path)
+        self.owner.close()
+        if self.temporary:
+            shutil.rmtree(self.root, True)
+
+    def create(self):
+        fd, name = tempfile.mkstemp(prefix='staging-', dir=self.path)
+        return StagingFile(self, fd, name)
+
+    def charge(self, size):
+        with self.lock:
+            if self.budget and size > 0 and self.used + size > self.budget:
+                raise FuseOSError(ENOSPC)
+            self.used += size
+
+    def hold(self, size):
+        with self.lock:
+            self.held += size
+
+    def over_budget(self):
+        return self.budget and self.used + self.held > self.budget
+
+class StagingFile:
+    """A sparse file accessed through a shared memory map, so reads and
+       writes are memory copies rather than seeks and syscalls. The file is
+       kept at least as long as the map and grown in doubling steps; size is
+       the length of the data in it. Only the ranges written since the last
+       upload count against the store's budget; filled holds the ranges of
+       clean data, which can be evicted and fetched again."""
+    min_capacity = 1048576
+
+    def __init__(self, store, fd, name):
+        self.store = store
+        self.fd = fd
+        self.name = name
+        self.map = None
+        self.address = 0
+        self.capacity = 0
+        self.size = 0
+        self.written = []
+        self.filled = []
+        self.closed = False
+
+    def remap(self, capacity):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.ftruncate(self.fd, capacity)
+        self.capacity = capacity
+        if capacity:
+            self.map = mmap.mmap(self.fd, capacity)
+            self.address = addressof(c_char.from_buffer(self.map))
+
+    def reserve(self, offset, length, dirty=True):
+        """Makes room for writing [offset, offset + length)."""
+        end = offset + length
+        if dirty:
+            self.store.charge(range_uncovered(self.written, offset, end))
+            mark_range(self.written, offset, end)
+            self.store.hold(-unmark_range(self.filled, offset, end))
+        else:
+            self.store.hold(range_uncovered(self.filled, offset, end))
+            mark_range(self.filled, offset, end)
+        if end > self.capacity:
+            self.remap(max(end, 2 * self.capacity, self.min_capacity))
+        self.size = max(self.size, end)
+
+    def read(self, offset, size):
+        if offset >= self.size:
+            return ''
+        return self.map[offset:min(offset + size, self.size)]
+
+    def write(self, offset, data, dirty=True):
+        if data:
+            self.reserve(offset, len(data), dirty)
+            self.map[offset:offset + len(data)] = data
+
+    def fill(self, offset, data):
+        """Writes data fetched from the server, which stays clean."""
+        self.write(offset, data, False)
+
+    def evict(self, offset, length):
+        """Forgets the clean data at [offset, offset + length) and gives
+           its disk space back."""
+        self.store.hold(-unmark_range(self.filled, offset, offset + length))
+        if punch_hole is not None:
+            punch_hole(self.fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length)
+
+    def clean(self, ranges):
+        """Marks everything uploaded: the written data no longer counts
+           against the budget and ranges, which hold what the server now
+           has, can be evicted."""
+        self.store.charge(-sum(end - start for start, end in self.written))
+        self.written = []
+        for start, end in ranges:
+            self.store.hold(range_uncovered(self.filled, start, end))
+            mark_range(self.filled, start, end)
+
+    def readinto(self, buf, size, offset):
+        """Copies up to size bytes at offset into the ctypes buffer buf and
+           returns how many were copied."""
+        size = max(min(size, self.size - offset), 0)
+        if size:
+            memmove(buf, self.address + offset, size)
+        return size
+
+    def write_from(self, buf, size, offset):
+        """Copies size bytes from the ctypes buffer buf to offset."""
+        if size:
+            self.reserve(offset, size)
+            memmove(self.address + offset, buf, size)
+
+    def truncate(self, length):
+        if length < self.size:
+            # drop the data past length, so growing again reads zeros
+            self.store.charge(-unmark_range(self.written, length, self.size))
+            self.store.hold(-unmark_range(self.filled, length, self.size))
+            self.remap(length)
+        elif length > self.capacity:
+            self.remap(length)
+        self.size = length
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+        os.unlink(self.name)
+        self.store.charge(-sum(end - start for start, end in self.written))
+        self.store.hold(-sum(end - start for start, end in self.filled))
+        self.written = []
+        self.filled = []
+
+class CopyObject(object):
+    """Metadata of one child of a listing. Names and types are interned,
+       as the same few strings repeat across millions of entries."""
+    __slots__ = ('name', 'type', 'size', 'ctime', 'mtime')
+
+    def __init__(self, name, type, size, ctime, mtime):
+        self.name = intern(name)
+        self.type = intern(type)
+        self.size = size
+        self.ctime = ctime
+        self.mtime = mtime
+
+class Listing(dict):
+    """The children of a directory by name, which also remembers the order
+       the server listed them in, for readdir offsets, and when it expires.
+       A removed child leaves None in names, so the others keep their
+       positions until a fresh listing replaces this one."""
+
+    def __init__(self):
+        dict.__init__(self)
+        self.names = []
+        # positions in names by name, built on the first removal
+        self.positions = None
+        self.expire = 0
+        # size as accounted by the ListingCache holding it
+        self.counted = 0
+        # lookups served from it, to tell hot directories apart
+        self.hits = 0
+        # when it was fetched, if it came from the metadata db and has not
+        # been fetched again since
+        self.saved = 0
+
+    def __setitem__(self, name, child):
+        if name not in self:
+            if self.positions is not None:
+                self.positions[name] = len(self.names)
+            self.names.append(name)
+        dict.__setitem__(self, name, child)
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        if self.positions is None:
+            self.positions = dict((other, i) for i, other in enumerate(self.names) if other is not None)
+        self.names[self.positions.pop(name)] = None
+
+class ListingCache:
+    """Listings by directory path, holding at most max_entries children in
+       total. Whole listings are evicted, least recently used first."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = 0
+        self.listings = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, path):
+        return path in self.listings
+
+    def __getitem__(self, path):
+        listing = self.get(path)
+        if listing is None:
+            raise KeyError(path)
+        return listing
+
+    def get(self, path, default=None):
+        with self.lock:
+            listing = self.listings.pop(path, None)
+            if listing is None:
+                return default
+            self.listings[path] = listing
+            return listing
+
+    def __setitem__(self, path, listing):
+        with self.lock:
+            old = self.listings.pop(path, None)
+            if old is not None:
+                self.entries -= old.counted
+            listing.counted = len(listing)
+            self.listings[path] = listing
+            self.entries += listing.counted
+            # never evict the listing just stored
+            while self.entries > self.max_entries and len(self.listings) > 1:
+                evicted_path, evicted = self.listings.popitem(last=False)
+                self.entries -= evicted.counted
+
+    def pop(self, path, default=None):
+        with self.lock:
+            listing = self.listings.pop(path, None)
+            if listing is None:
+                return default
+            self.entries -= listing.counted
+            return listing
+
+    def discard_tree(self, path):
+        """Drops the listings of path and of every directory below it."""
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            for listed in [listed for listed in self.listings if listed == path or listed.startswith(prefix)]:
+                self.entries -= self.listings.pop(listed).counted
+
+class PartialListing:
+    """A listing that is still being fetched. Readers can go through the
+       children received so far and wait for the rest."""
+    # children decoded between wake-ups of waiting readers
+    publish_every = 1000
+
+    def __init__(self):
+        self.children = Listing()
+        self.done = False
+        self.error = None
+        self.published = 0
+        self.cond = Condition()
+
+    def add(self, name, child):
+        self.children[name] = child
+        if len(self.children.names) - self.published >= self.publish_every:
+            self.publish()
+
+    def publish(self):
+        with self.cond:
+            self.published = len(self.children.names)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.error = error
+            self.done = True
+            self.published = len(self.children.names)
+            self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            while not self.done:
+                self.cond.wait()
+        if self.error is not None:
+            raise self.error
+        return self.children
+
+    def iter_from(self, start):
+        """Yields the (position, name, child) triples from position start
+           on, as they arrive."""
+        position = start
+        while True:
+            with self.cond:
+                while position >= self.published and not self.done:
+                    self.cond.wait()
+                end = self.published
+                if position >= end:
+                    if self.error is not None:
+                        raise self.error
+                    return
+            # names are only appended to or blanked, so no copy is needed
+            names = self.children.names
+            for i in xrange(position, end):
+                child = self.children.get(names[i])
+                if child is not None:
+                    yield i, names[i], child
+            position = end
+
+class JSONStream:
+    """Decodes a JSON object read from a file-like object a piece at a
+       time, yielding the elements of one of its array members as they are
+       read instead of holding the whole document."""
+    decoder = json.JSONDecoder(encoding='latin-1')
+    chunk_size = 65536
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            raise ValueError('truncated JSON document')
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ''
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected %r in JSON document' % char)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may continue in the next
+                # chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def members(self, key, extra):
+        """Yields the elements of the array member key. Every other member is
+           stored in extra, as is key itself (as True) once it has been seen."""
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            name = self.value()
+            self.expect(':')
+            if name == key and self.peek() == '[':
+                extra[key] = True
+                self.expect('[')
+                if self.peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield self.value()
+                        if self.peek() == ']':
+                            self.pos += 1
+                            break
+                        self.expect(',')
+            else:
+                extra[name] = self.value()
+            if self.peek() == '}':
+                return
+            self.expect(',')
+
+class MetadataStore:
+    """Directory listings saved in SQLite together with the time they were
+       fetched, so that a new mount can start from the previous one's."""
+
+    def __init__(self, path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS listings (path TEXT PRIMARY KEY, fetched REAL, children TEXT)')
+        self.db.commit()
+
+    def get(self, path):
+        """Returns a (fetched, children) tuple, or None."""
+        with self.lock:
+            row = self.db.execute('SELECT fetched, children FROM listings WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        children = Listing()
+        for name, type, size, ctime, mtime in json.loads(row[1]):
+            child = CopyObject(str(name), str(type), size, ctime, mtime)
+            children[child.name] = child
+        return row[0], children
+
+    def put(self, path, fetched, children):
+        rows = [(child.name, child.type, child.size, child.ctime, child.mtime) for child in (children[name] for name in children.names if name is not None)]
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?)', (path, fetched, json.dumps(rows)))
+            self.db.commit()
+
+    def discard(self, path):
+        with self.lock:
+            self.db.execute('DELETE FROM listings WHERE path = ?', (path,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class SingleFlight:
+    """Runs one call at a time per key; callers arriving while it runs wait
+       for it and share its result or exception."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            owner = call is None
+            if owner:
+                call = self.calls[key] = {'done': Event(), 'result': None, 'error': None}
+
+        if owner:
+            try:
+                call['result'] = fn(*args)
+            except Exception, e:
+                call['error'] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call['done'].set()
+        else:
+            call['done'].wait()
+
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+class Metrics:
+    """Counters, gauges and latency histograms of a mount, rendered as a
+       plain dict by snapshot. Latencies are kept per name within a group
+       (FUSE operations, API requests), bucketed by the upper bounds in
+       seconds below."""
+    bounds = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, fn):
+        """Registers fn, called on every snapshot, as the value of name."""
+        self.gauges[name] = fn
+
+    def observe(self, group, name, seconds, failed=False):
+        with self.lock:
+            timings = self.timings.setdefault(group, {})
+            timing = timings.get(name)
+            if timing is None:
+                timing = timings[name] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0, 'buckets': [0] * (len(self.bounds) + 1)}
+            timing['count'] += 1
+            if failed:
+                timing['errors'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['buckets'][bisect_left(self.bounds, seconds)] += 1
+
+    @contextmanager
+    def timed(self, group, name):
+        started = time.time()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.observe(group, name, time.time() - started, failed)
+
+    def ratio(self, hits, misses):
+        total = self.counters.get(hits, 0) + self.counters.get(misses, 0)
+        if total == 0:
+            return None
+        return float(self.counters.get(hits, 0)) / total
+
+    def snapshot(self):
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception:
+                gauges[name] = None
+        labels = ['<=%gs' % bound for bound in self.bounds] + ['>%gs' % self.bounds[-1]]
+        with self.lock:
+            timings = {}
+            for group, names in self.timings.items():
+                timings[group] = {}
+                for name, timing in names.items():
+                    timings[group][name] = {'count': timing['count'], 'errors': timing['errors'],
+                                            'mean_ms': round(timing['total'] * 1000 / timing['count'], 3), 'max_ms': round(timing['max'] * 1000, 3),
+                                            'buckets': dict((label, n) for label, n in zip(labels, timing['buckets']) if n)}
+            return {'uptime': round(time.time() - self.started, 3),
+                    'counters': dict(self.counters),
+                    'gauges': gauges,
+                    'ratios': {'listing_cache_hits': self.ratio('listing_cache_hits', 'listing_cache_misses'),
+                               'block_cache_hits': self.ratio('block_cache_hits', 'block_cache_misses'),
+                               'bytes_deduplicated': self.ratio('bytes_deduplicated', 'bytes_sent')},
+                    'timings': timings}
+
+class Tracer:
+    """Keeps the most recent FUSE operations as compact records in a ring
+       buffer. Recording only appends a tuple to a bounded deque, which is
+       atomic, so it takes no lock; arguments are reduced to numbers and
+       sizes (a write is recorded by its length, not its data) and records
+       are only turned into JSON lines when read. Tracing can be switched
+       on and off, sampled to one in every sample operations and limited
+       to some operations while the file system runs. With a logfile,
+       every record is also written to it as it happens."""
+
+    def __init__(self, size=10000, enabled=False, sample=1, ops=None, logfile=None):
+        self.records = deque(maxlen=size)
+        self.enabled = enabled
+        self.sample = sample
+        self.ops = ops
+        self.logfile = logfile
+        self.counter = count()
+
+    def record(self, op, path, args, result, error, seconds):
+        if self.ops is not None and op not in self.ops:
+            return
+        if self.sample > 1 and next(self.counter) % self.sample:
+            return
+        # paths (the target of a rename) are kept, other strings by length
+        args = tuple(arg if isinstance(arg, (int, long)) or (isinstance(arg, str) and arg.startswith('/')) else
+                     len(arg) if isinstance(arg, str) else None for arg in args)
+        if isinstance(result, str):
+            result = len(result)
+        elif not isinstance(result, (int, long)):
+            result = None
+        record = (time.time(), op, path, args, result, error, seconds)
+        self.records.append(record)
+        if self.logfile:
+            print >> self.logfile, self.format(record)
+
+    def format(self, record):
+        stamp, op, path, args, result, error, seconds = record
+        entry = {'time': round(stamp, 6), 'op': op, 'path': path, 'args': args, 'ms': round(seconds * 1000, 3)}
+        if error is not None:
+            entry['error'] = errorcode.get(error, error)
+        else:
+            entry['result'] = result
+        return json.dumps(entry)
+
+    def text(self):
+        return ''.join(self.format(record) + '\n' for record in list(self.records))
+
+    def configure(self, text):
+        """Applies commands separated by white space: on, off, clear,
+           sample=N, ops=op,op (or ops=all) and size=N."""
+        for command in text.split():
+            key, _, value = command.partition('=')
+            if key == 'on':
+                self.enabled = True
+            elif key == 'off':
+                self.enabled = False
+            elif key == 'clear':
+                self.records.clear()
+            elif key == 'sample' and value.isdigit() and int(value) > 0:
+                self.sample = int(value)
+            elif key == 'ops' and value:
+                self.ops = None if value == 'all' else frozenset(value.split(','))
+            elif key == 'size' and value.isdigit() and int(value) > 0:
+                self.records = deque(self.records, int(value))
+            else:
+                raise FuseOSError(EINVAL)
+
+    def status(self):
+        return 'enabled=%d sample=%d ops=%s size=%d' % (self.enabled, self.sample, ','.join(sorted(self.ops)) if self.ops is not None else 'all', self.records.maxlen)
+
+class MetadataBatcher:
+    """Groups the update_objects actions of concurrent callers into shared
+       requests. An action submitted while no request is in flight is sent
+       right away; while one is in flight, actions collect for up to window
+       seconds or max_actions actions and are sent together. Every caller
+       waits for and gets the result of its own action."""
+
+    def __init__(self, send, max_actions=500, window=0.05):
+        self.send = send
+        self.max_actions = max_actions
+        self.window = window
+        self.cond = Condition()
+        self.batch = None
+        self.inflight = 0
+
+    def submit(self, action):
+        with self.cond:
+            batch = self.batch
+            leader = batch is None or len(batch['actions']) >= self.max_actions
+            if leader:
+                batch = self.batch = {'actions': [], 'results': None, 'error': None, 'done': Event()}
+            index = len(batch['actions'])
+            batch['actions'].append(action)
+            if len(batch['actions']) >= self.max_actions:
+                self.cond.notify_all()
+
+            if leader:
+                deadline = time.time() + self.window
+                while self.inflight and len(batch['actions']) < self.max_actions and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                if self.batch is batch:
+                    self.batch = None
+                self.inflight += 1
+
+        if leader:
+            try:
+                batch['results'] = self.send(batch['actions'])
+            except Exception, e:
+                batch['error'] = e
+            finally:
+                with self.cond:
+                    self.inflight -= 1
+                    self.cond.notify_all()
+                batch['done'].set()
+
+        batch['done'].wait()
+        if batch['error'] is not None:
+            raise batch['error']
+        return batch['results'][index]
 
 class CopyAPI:
+    # parts per has_parts/send_parts round trip
+    batch_parts = 8
+    refresh_ahead = 0.2
+    # seconds local changes are kept in the journal, and the most
+    # directories kept in it before old entries are swept out
+    journal_age = 300
+    journal_dirs = 1000
+    # children per list_objects page
+    page_items = 1000
     headers = {'X-Client-Type': 'api', 'X-Api-Version': '1', "Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, meta_connections=4, data_connections=4, cache_dir=None, cache_size=0, metadata_db=None, metadata_max_age=86400, max_cached_entries=1000000, chunker=None, api_url=None, listing_ttl=10, stale_ttl=0, hot_hits=0):
         self.auth_token = ''
-        self.tree_children = {}
-        self.tree_expire = {}
-        self.httpconn = urllib3.connection_from_url("https://next-api.copy.com", block=True, maxsize=1)
+        self.tree_children = ListingCache(max_cached_entries)
+        self.chunker = chunker or FixedChunker()
+        self.update_batcher = MetadataBatcher(self.update_objects)
+        self.flights = SingleFlight()
+        self.metrics = Metrics()
+        self.meta_connections = meta_connections
+        self.data_connections = data_connections
+        self.upload_pool = None
+        self.refresh_pool = None
+        self.refresh_lock = Lock()
+        self.refreshing = set()
+        self.listing_lock = Lock()
+        self.listings_pending = {}
+        # changes made through this mount by parent directory, as (time,
+        # name, child or None once removed)
+        self.journal = {}
+        self.journal_lock = Lock()
+        self.metadata_db = metadata_db
+        self.metadata_max_age = metadata_max_age
+        # listings are fresh for listing_ttl seconds and then served for up
+        # to stale_ttl more while they are fetched again in the background.
+        # A listing looked up hot_hits times is refreshed ahead of expiry
+        # once it is within refresh_ahead of it (as a fraction of the TTL)
+        self.listing_ttl = listing_ttl
+        self.stale_ttl = stale_ttl
+        self.hot_hits = hot_hits
+        self.metadata_store = None
+        if cache_dir is not None and cache_size > 0:
+            self.block_cache = BlockCache(cache_dir, cache_size)
+        else:
+            self.block_cache = None
+        # metadata calls (auth, listings, mutations) and bulk transfers
+        # (downloads, parts) use separate pools so that a slow download never
+        # holds up a getattr waiting for a free connection
+        self.meta_pool = urllib3.connection_from_url(api_url or API_URL, block=True, maxsize=meta_connections)
+        self.data_pool = urllib3.connection_from_url(api_url or API_URL, block=True, maxsize=data_connections)
         data = {'username': username, 'password' : password}
         response = self.copyrequest('/auth_user', data)
         if 'auth_token' not in response:
@@ -32,186 +1066,1093 @@ class CopyAPI:
         else:
             self.auth_token = response['auth_token'].encode('ascii','ignore')
 
-    def copyrequest(self, uri, data, return_json=True):
-        headers = self.headers
+    def request_headers(self):
+        # build a fresh dict per request, the class-level headers are shared
+        # between all threads
+        headers = dict(self.headers)
         if self.auth_token != '':
             headers['X-Authorization'] = self.auth_token
-        response = self.httpconn.request_encode_body("POST", uri, {'data': json.dumps(data)}, headers, False)
+        return headers
+
+    def copyrequest(self, uri, data, return_json=True, bulk=False):
+        pool = self.data_pool if bulk else self.meta_pool
+        with self.metrics.timed('requests', uri):
+            response = pool.request_encode_body("POST", uri, {'data': json.dumps(data)}, self.request_headers(), False)
+        self.metrics.count('bytes_received', len(response.data))
         if return_json == True:
             return json.loads(response.data, 'latin-1')
         else:
             return response.data
 
-    def part_request(self, method, parts, data=None):
-        headers = self.headers
+    def part_request(self, method, parts, data=None, source=None):
+        with self.metrics.timed('requests', '/' + method):
+            return self.send_part_request(method, parts, data, source)
+
+    def send_part_request(self, method, parts, data=None, source=None):
+        headers = self.request_headers()
         headers['X-Part-Count'] = len(parts)
 
-        payload = ''
+        length = 0
 
         for i in range(0, len(parts)):
             part_num = str(i + 1)
             headers['X-Part-Fingerprint-' + part_num] = parts[i]['fingerprint']
             headers['X-Part-Size-' + part_num] = parts[i]['size']
             headers['X-Part-Share-' + part_num] = 0
-
-            if method == 'send_parts':
-                payload = payload + parts[i]['data']
-
-        # authentication http headers
-        if self.auth_token != '':
-            headers['X-Authorization'] = self.auth_token
+            length += parts[i]['size']
 
         # print headers
 
-        if method == 'has_parts':
-            response = self.httpconn.request_encode_body("POST", "/" + method, {'data': json.dumps(data)}, headers, False)
+        if method == 'get_parts':
+            # the response body is the raw data of the parts, in order
+            response = self.data_pool.request_encode_body("POST", "/" + method, {'data': json.dumps(data)}, headers, False)
+            self.metrics.count('bytes_received', len(response.data))
+            return response.data
+        elif method == 'has_parts':
+            response = self.data_pool.request_encode_body("POST", "/" + method, {'data': json.dumps(data)}, headers, False)
         else:
-            response = self.httpconn.urlopen("POST", "/" + method, payload, headers)
+            # stream the part data straight out of the source file
+            headers['Content-Length'] = length
+            self.metrics.count('bytes_sent', length)
+            self.metrics.count('parts_sent', len(parts))
+            payload = PartReader(source, parts)
+            try:
+                response = self.data_pool.urlopen("POST", "/" + method, payload, headers)
+            finally:
+                payload.close()
 
         return json.loads(response.data, 'latin-1')
 
-    def list_objects(self, path, ttl=10):
+    def list_objects(self, path, ttl=None):
+        if ttl is None:
+            ttl = self.listing_ttl
+        listing = self.cached_listing(path, ttl)
+        if listing is not None:
+            return listing
+
+        return self.fetch_listing(path, ttl)
+
+    def iter_objects(self, path, start=0, ttl=None):
+        """Yields the (position, name, child) triples of path from position
+           start on; positions stay put when children are removed.
+           A listing that is not cached yet is streamed as its pages arrive
+           instead of after the whole directory has been fetched."""
+        if ttl is None:
+            ttl = self.listing_ttl
+        listing = self.cached_listing(path, ttl)
+        if listing is None:
+            partial, owner = self.begin_listing(path)
+            if owner:
+                # a thread of its own, as a refresh queued on the refresh
+                # pool would wait for it
+                thread = Thread(target=self.stream_listing, args=(path, ttl, partial))
+                thread.daemon = True
+                thread.start()
+            for item in partial.iter_from(start):
+                yield item
+            return
+
+        # the kernel takes a hundred or so entries per call, so walk the
+        # names from start rather than copying all the rest of them
+        names = listing.names
+        for position in xrange(start, len(names)):
+            child = listing.get(names[position])
+            if child is not None:
+                yield position, names[position], child
+
+    def cached_listing(self, path, ttl):
         # check cache
-        if path in self.tree_expire:
-            if self.tree_expire[path] >= time.time():
-                return self.tree_children[path]
-
-        # obtain data from copy
+        listing = self.tree_children.get(path)
+        if listing is not None:
+            now = time.time()
+            listing.hits += 1
+            if listing.expire >= now:
+                if self.hot_hits and listing.hits >= self.hot_hits and listing.expire - now < ttl * self.refresh_ahead:
+                    if self.refresh_listing(path, ttl):
+                        self.metrics.count('listings_refreshed_ahead')
+                self.metrics.count('listing_cache_hits')
+                return listing
+            # a listing from the metadata db is stale from the start, and
+            # served until its revalidation lands whatever stale_ttl is
+            stale_ok = listing.expire + self.stale_ttl >= now or listing.saved + self.metadata_max_age >= now
+            if stale_ok and self.refresh_pool is not None:
+                # serve it while a fresh copy is fetched
+                if self.refresh_listing(path, ttl):
+                    self.metrics.count('listings_served_stale')
+                self.metrics.count('listing_cache_hits')
+                return listing
+
+        # a listing saved by an earlier mount is served right away and
+        # revalidated in the background, as long as it is not too old
+        elif self.metadata_store is not None:
+            saved = self.metadata_store.get(path)
+            if saved is not None and saved[0] + self.metadata_max_age >= time.time():
+                listing = saved[1]
+                listing.expire = saved[0] + ttl
+                listing.saved = saved[0]
+                self.tree_children[path] = listing
+                if listing.expire < time.time():
+                    self.refresh_listing(path, ttl)
+                self.metrics.count('listing_cache_hits')
+                self.metrics.count('listings_from_metadata_db')
+                return listing
+
+        self.metrics.count('listing_cache_misses')
+        return None
+
+    def begin_listing(self, path):
+        """Returns the PartialListing of the fetch of path in progress and
+           whether the caller started it and so has to run it."""
+        with self.listing_lock:
+            if path in self.listings_pending:
+                return self.listings_pending[path], False
+            partial = PartialListing()
+            self.listings_pending[path] = partial
+            return partial, True
+
+    def fetch_listing(self, path, ttl):
+        partial, owner = self.begin_listing(path)
+        if owner:
+            self.stream_listing(path, ttl, partial)
+        return partial.wait()
+
+    def stream_listing(self, path, ttl, partial):
+        """Fetches the listing of path page by page into partial, decoding
+           each page as it is received, then caches it."""
         # print "listing objects from cloud for path: " + path
-        data = {'path': path, 'max_items': 1000000}
-        response = self.copyrequest('/list_objects', data)
-        if 'children' not in response:
+        fetched = time.time()
+        try:
+            watermark = 0
+            while True:
+                data = {'path': path, 'max_items': self.page_items, 'list_watermark': watermark}
+                with self.metrics.timed('requests', '/list_objects'):
+                    response = self.meta_pool.request_encode_body("POST", '/list_objects', {'data': json.dumps(data)}, self.request_headers(), False, preload_content=False)
+                extra = {}
+                count = 0
+                try:
+                    for child in JSONStream(response).members('children', extra):
+                        name = str(os.path.basename(child['path']))
+                        ctime = int(child['created_time'])
+                        if child['modified_time'] == None:
+                            mtime = ctime
+                        else:
+                            mtime = int(child['modified_time'])
+                        partial.add(name, CopyObject(name, str(child['type']), int(child['size']), ctime, mtime))
+                        count += 1
+                finally:
+                    response.release_conn()
+                if 'children' not in extra:
+                    raise FuseOSError(EIO)
+                partial.publish()
+                watermark += count
+                # a server that does not page returns everything at once
+                if not extra.get('more_items') or count == 0:
+                    break
+
+            # update expiration time
+            partial.children.expire = fetched + ttl
+
+            with self.journal_lock:
+                # changes made after the fetch started may be missing
+                entries = [entry for entry in self.journal.get(path, []) if entry[0] >= fetched]
+                for stamp, name, child in entries:
+                    self.patch_listing(partial.children, name, child)
+                if entries:
+                    self.journal[path] = entries
+                else:
+                    self.journal.pop(path, None)
+                self.tree_children[path] = partial.children
+
+            if self.metadata_store is not None:
+                self.metadata_store.put(path, fetched, partial.children)
+        except Exception, e:
+            partial.finish(e)
+        else:
+            partial.finish()
+        finally:
+            with self.listing_lock:
+                del self.listings_pending[path]
+
+    def apply_local(self, path, child):
+        """Applies a change made through this mount to the cached listing of
+           the parent of path: child is what is at path now, or None once it
+           was removed. The change is journaled too, so that a listing whose
+           fetch was already under way gets it when it arrives."""
+        parent = os.path.dirname(path)
+        name = str(os.path.basename(path))
+        now = time.time()
+        with self.journal_lock:
+            if len(self.journal) > self.journal_dirs:
+                for listed in self.journal.keys():
+                    entries = [entry for entry in self.journal[listed] if entry[0] >= now - self.journal_age]
+                    if entries:
+                        self.journal[listed] = entries
+                    else:
+                        del self.journal[listed]
+            self.journal.setdefault(parent, []).append((now, name, child))
+            listing = self.tree_children.get(parent)
+            if listing is not None:
+                self.patch_listing(listing, name, child)
+        # a later mount fetches the directory again rather than trusting it
+        if self.metadata_store is not None:
+            self.metadata_store.discard(parent)
+
+    def patch_listing(self, listing, name, child):
+        if child is None:
+            if name in listing:
+                del listing[name]
+        else:
+            listing[name] = child
+
+    def refresh_listing(self, path, ttl):
+        """Fetches the listing of path again on the refresh pool, unless a
+           refresh of it is already queued, and tells whether it queued
+           one."""
+        with self.refresh_lock:
+            if path in self.refreshing or self.refresh_pool is None:
+                return False
+            self.refreshing.add(path)
+        self.refresh_pool.apply_async(self.refresh_task, (path, ttl))
+        return True
+
+    def refresh_task(self, path, ttl):
+        try:
+            # a fetch already under way refreshes it just as well, and
+            # waiting for it would hold up a thread of the pool
+            partial, owner = self.begin_listing(path)
+            if owner:
+                self.stream_listing(path, ttl, partial)
+        except Exception:
+            # the next access that finds the listing expired tries again
+            pass
+        finally:
+            with self.refresh_lock:
+                self.refreshing.discard(path)
+
+    def update_object(self, action):
+        """Applies one update_objects action, batched with those of other
+           threads, and raises EIO if it failed."""
+        if not self.update_batcher.submit(action):
             raise FuseOSError(EIO)
 
-        # build tree
-        self.tree_children[path] = {}
-        for child in response['children']:
-            name = str(os.path.basename(child['path']))
-            ctime = int(child['created_time'])
-            if child['modified_time'] == None:
-                mtime = ctime
+    def update_objects(self, actions):
+        """Sends a batch of update_objects actions and returns whether each
+           of them succeeded."""
+        params = {'meta': {}}
+        for i in range(0, len(actions)):
+            params['meta'][i] = actions[i]
+        response = self.copyrequest('/update_objects', params, True)
+
+        # per-action results when the server reports them, otherwise the
+        # overall result applies to every action
+        results = response.get('objects')
+        if isinstance(results, list) and len(results) == len(actions):
+            return [result.get('result', response.get('result')) == 'success' for result in results]
+        return [response.get('result') == 'success'] * len(actions)
+
+    def object_parts(self, path):
+        """Returns the parts of the latest revision of a file, or None when
+           the server does not report them. Concurrent calls for one path
+           share a single request."""
+        parts = self.flights.do(('object_parts', path), self.fetch_object_parts, path)
+        if parts is None:
+            return None
+        return list(parts)
+
+    def fetch_object_parts(self, path):
+        response = self.copyrequest('/list_objects', {'path': path, 'include_parts': True})
+        try:
+            parts = response['object']['revisions'][0]['parts']
+        except (KeyError, IndexError, TypeError):
+            return None
+        return [{'fingerprint': str(part['fingerprint']), 'offset': int(part['offset']), 'size': int(part['size'])} for part in parts]
+
+    def get_parts(self, parts):
+        """Returns the data of each part, from the block cache where possible
+           and otherwise fetched from the server in batches."""
+        found = {}
+        missing = []
+        for part in parts:
+            key = part['fingerprint'] + '-' + str(part['size'])
+            if key in found:
+                continue
+            data = self.block_cache.get(key) if self.block_cache else None
+            if data is None:
+                missing.append(part)
+                found[key] = None
+                self.metrics.count('block_cache_misses')
             else:
-                mtime = int(child['modified_time'])
-            self.tree_children[path][name] = {'name': name, 'type': child['type'], 'size': child['size'], 'ctime': ctime, 'mtime': mtime}
-
-        # update expiration time
-        self.tree_expire[path] = time.time() + ttl
-
-        return self.tree_children[path]
-
-    def partify(self, f, size):
+                found[key] = data
+                self.metrics.count('block_cache_hits')
+
+        for i in range(0, len(missing), self.batch_parts):
+            batch = missing[i:i + self.batch_parts]
+            payload = self.part_request('get_parts', batch)
+            offset = 0
+            for part in batch:
+                key = part['fingerprint'] + '-' + str(part['size'])
+                data = payload[offset:offset + part['size']]
+                offset += part['size']
+                if len(data) != part['size'] or hashlib.md5(data).hexdigest() + hashlib.sha1(data).hexdigest() != part['fingerprint']:
+                    raise FuseOSError(EIO)
+                if self.block_cache:
+                    self.block_cache.put(key, data)
+                found[key] = data
+
+        return [found[part['fingerprint'] + '-' + str(part['size'])] for part in parts]
+
+    def download_object(self, path):
+        """Returns the whole contents of path. Only used for files whose
+           parts the server does not report."""
+        raw = self.copyrequest("/download_object", {'path': path}, False, bulk=True)
+        # remember the blocks so that later reads hit the cache
+        if self.block_cache:
+            for offset in range(0, len(raw), PART_SIZE):
+                part_data = raw[offset:offset + PART_SIZE]
+                self.block_cache.put(hashlib.md5(part_data).hexdigest() + hashlib.sha1(part_data).hexdigest() + '-' + str(len(part_data)), part_data)
+        return raw
+
+    def partify(self, f, layout):
+        """Yields the parts to upload along with whether each had to be
+           hashed. Entries of layout with a fingerprint are unchanged parts
+           and passed on as they are; the others are changed spans of the
+           file, which are read, cut into parts by the chunker and hashed."""
+        for span in layout:
+            if span['fingerprint'] is not None:
+                yield span, False
+                continue
+            for offset, part_data in self.chunker.chunks(f, span['offset'], span['size']):
+                yield {'fingerprint': hashlib.md5(part_data).hexdigest() + hashlib.sha1(part_data).hexdigest(), 'offset': offset, 'size': len(part_data)}, True
+
+    def start(self):
+        # threads (and sqlite connections) do not survive the fork when fuse
+        # daemonizes, so this is called from CopyFUSE.init rather than from
+        # __init__
+        self.upload_pool = ThreadPool(self.data_connections)
+        self.refresh_pool = ThreadPool(self.meta_connections)
+        if self.metadata_db is not None:
+            self.metadata_store = MetadataStore(self.metadata_db)
+
+    def stop(self):
+        if self.upload_pool is not None:
+            self.upload_pool.close()
+            self.upload_pool.join()
+            self.upload_pool = None
+        if self.refresh_pool is not None:
+            self.refresh_pool.terminate()
+            self.refresh_pool = None
+        if self.metadata_store is not None:
+            self.metadata_store.close()
+            self.metadata_store = None
+        self.meta_pool.close()
+        self.data_pool.close()
+
+    def upload(self, source, layout):
+        """Sends the parts of layout, read from the file at source, that
+           the server does not have yet and returns the part list for
+           update_objects. Parts without a fingerprint are hashed on the
+           calling thread while has_parts/send_parts for earlier batches run
+           on the upload pool, several batches at a time; parts that already
+           have one are unchanged and not negotiated again."""
         parts = {}
-
-        part_num = 0
-        offset = 0
-        while f.tell() < size:
-            # obtain the part data
-            offset = f.tell()
-            part_data = f.read(1048576)
-            parts[part_num] = {'fingerprint': hashlib.md5(part_data).hexdigest() + hashlib.sha1(part_data).hexdigest(), 'offset': offset, 'size': len(part_data), 'data': part_data}
-            offset = f.tell()
-            part_num += 1
-
-        if size != offset:
-            # print str(size) + " != " + str(offset)
-            raise FuseOSError(EIO)
+        results = []
+        batch = []
+        inflight = Semaphore(self.data_connections * 2)
+
+        with open(source, 'rb') as f:
+            for part, hashed in self.partify(f, layout):
+                parts[len(parts)] = part
+                if not hashed:
+                    continue
+                batch.append(part)
+                if len(batch) == self.batch_parts:
+                    inflight.acquire()
+                    results.append(self.upload_pool.apply_async(self.upload_batch, (batch, source, inflight)))
+                    batch = []
+                    # stop hashing as soon as a batch has failed
+                    if any(r.ready() and not r.successful() for r in results):
+                        break
+        if batch:
+            inflight.acquire()
+            results.append(self.upload_pool.apply_async(self.upload_batch, (batch, source, inflight)))
+
+        # re-raises the first error of any batch
+        for result in results:
+            result.get()
 
         return parts
 
-class CopyFUSE(LoggingMixIn, Operations):
-    def __init__(self, username, password, logfile=None):
-        self.rwlock = Lock()
-        self.copy_api = CopyAPI(username, password)
+    def upload_batch(self, batch, source, inflight):
+        try:
+            # obtain list of parts that need to be sent
+            response = self.part_request('has_parts', batch)
+
+            if 'send_parts' not in response:
+                raise FuseOSError(EIO)
+
+            need_parts = set()
+            for need_part in response['send_parts']:
+                need_parts.add(need_part['fingerprint'] + '-' + str(need_part['size']))
+
+            # send the missing parts, once each
+            send_parts = []
+            for part in batch:
+                key = part['fingerprint'] + '-' + str(part['size'])
+                if key in need_parts:
+                    need_parts.remove(key)
+                    send_parts.append(part)
+                else:
+                    self.metrics.count('bytes_deduplicated', part['size'])
+            if send_parts:
+                response = self.part_request('send_parts', send_parts, source=source)
+
+                # trap any errors
+                if (response == False or response['result'] != 'success'):
+                    raise FuseOSError(EIO)
+        finally:
+            inflight.release()
+
+class WritebackQueue:
+    """Uploads dirty files in the background. A file is uploaded once it
+       has gone delay seconds without being queued again, so a file that is
+       flushed many times in a row is uploaded once; at most workers uploads
+       run at the same time. Failed uploads are retried after the delay;
+       while draining, a file is given up on after drain_retries failures
+       so that unmounting does not wait for a server that keeps refusing."""
+    drain_retries = 3
+
+    def __init__(self, upload, delay, workers, logfile=None):
+        self.upload = upload
+        self.delay = delay
+        self.workers = workers
         self.logfile = logfile
+        self.due = {}
+        self.active = set()
+        self.cond = Condition()
+        self.threads = []
+        self.stopping = False
+        self.draining = False
+        # failed uploads by path, while draining
+        self.failures = {}
+
+    def start(self):
+        for i in range(self.workers):
+            thread = Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.drain()
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def __len__(self):
+        with self.cond:
+            return len(self.due) + len(self.active)
+
+    def add(self, path):
+        with self.cond:
+            self.due[path] = time.time() + self.delay
+            self.cond.notify()
+
+    def wait(self, path):
+        """Takes path off the queue and waits for an upload of it that is
+           already running, so the caller can upload it itself."""
+        with self.cond:
+            self.due.pop(path, None)
+            while path in self.active:
+                self.cond.wait()
+
+    def drain(self):
+        """Uploads everything queued right away and waits for it."""
+        with self.cond:
+            self.draining = True
+            for path in self.due:
+                self.due[path] = 0
+            self.cond.notify_all()
+            while (self.due or self.active) and self.threads:
+                self.cond.wait()
+            self.draining = False
+            self.failures = {}
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.stopping:
+                        return
+                    ready = [(due, path) for path, due in self.due.items() if path not in self.active]
+                    if ready:
+                        due, path = min(ready)
+                        if due <= time.time():
+                            break
+                        self.cond.wait(due - time.time())
+                    else:
+                        self.cond.wait()
+                del self.due[path]
+                self.active.add(path)
+            try:
+                self.upload(path)
+            except Exception, e:
+                if self.logfile:
+                    print >> self.logfile, 'write-back of', path, 'failed:', e
+                with self.cond:
+                    if self.draining:
+                        self.failures[path] = self.failures.get(path, 0) + 1
+                    if self.failures.get(path, 0) >= self.drain_retries:
+                        # its changes are lost, so say so even without a log
+                        print >> self.logfile or stderr, 'write-back of', path, 'given up, changes are lost'
+                    else:
+                        self.due.setdefault(path, time.time() + self.delay)
+            finally:
+                with self.cond:
+                    self.active.discard(path)
+                    self.cond.notify_all()
+
+class RWLock:
+    """A lock held either by any number of readers or by a single writer.
+       A waiting writer holds off new readers."""
+
+    def __init__(self):
+        self.cond = Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class CopyFUSE(Operations):
+    # most missing paths remembered at once
+    negative_size = 10000
+    readdir_offsets = True
+    # directory of the synthetic files describing the mount itself, and the
+    # operations allowed below it
+    virtual_dir = '/.copyfuse'
+    virtual_ops = frozenset(['getattr', 'open', 'read', 'read_buf', 'write', 'write_buf', 'truncate', 'flush', 'fsync', 'release', 'readdir', 'statfs'])
+
+    def __init__(self, username, password, logfile=None, meta_connections=4, data_connections=4, cache_dir=None, cache_size=0, readahead=0, metadata_db=None, negative_timeout=10, max_cached_entries=1000000, writeback=False, writeback_delay=2, writeback_workers=2, chunker=None, staging_dir=None, staging_size=0, api_url=None, tracer=None, listing_ttl=10, stale_ttl=0, hot_hits=0):
+        self.copy_api = CopyAPI(username, password, meta_connections, data_connections, cache_dir, cache_size, metadata_db, max_cached_entries=max_cached_entries, chunker=chunker, api_url=api_url, listing_ttl=listing_ttl, stale_ttl=stale_ttl, hot_hits=hot_hits)
+        self.logfile = logfile
+        # staging copies by path, shared by all handles open on the path
         self.files = {}
-
-    def file_rename(self, old, new):
-        if old in self.files:
-            self.files[new] = self.files[old]
-            del self.files[old]
-
-    def file_get(self, path, download=True):
-        if path in self.files:
-            return self.files[path]
-
-        if download == True:
-            raw = self.copy_api.copyrequest("/download_object", {'path': path}, False)
+        # open handles by fh
+        self.handles = {}
+        self.next_fh = 1
+        self.files_lock = Lock()
+        self.staging = StagingStore(staging_dir, staging_size)
+        self.readahead = readahead
+        self.prefetch_pool = None
+        # paths recently found missing, oldest first
+        self.negative = OrderedDict()
+        self.negative_lock = Lock()
+        self.negative_timeout = negative_timeout
+        if writeback:
+            self.writeback = WritebackQueue(self.file_writeback, writeback_delay, writeback_workers, logfile)
         else:
-            raw = ''
+            self.writeback = None
+        # contents of the files in virtual_dir by name, and the latest
+        # rendering of each as (time, text)
+        self.virtual_files = {'stats': self.stats_text, 'trace': self.trace_text}
+        self.virtual_cache = {}
+        # virtual files that take commands when written to
+        self.virtual_controls = {'trace': self.trace_control}
+        self.tracer = tracer or Tracer(logfile=logfile, enabled=logfile is not None)
+
+        self.metrics = self.copy_api.metrics
+        self.metrics.gauge('open_files', lambda: len(self.files))
+        self.metrics.gauge('open_handles', lambda: len(self.handles))
+        self.metrics.gauge('staging_bytes', lambda: self.staging.used)
+        self.metrics.gauge('staging_clean_bytes', lambda: self.staging.held)
+        self.metrics.gauge('writeback_queue', lambda: len(self.writeback) if self.writeback is not None else 0)
+        self.metrics.gauge('cached_listings', lambda: len(self.copy_api.tree_children.listings))
+        self.metrics.gauge('cached_entries', lambda: self.copy_api.tree_children.entries)
+        self.metrics.gauge('block_cache_bytes', lambda: self.copy_api.block_cache.used if self.copy_api.block_cache else 0)
+        self.metrics.gauge('negative_entries', lambda: len(self.negative))
+
+    def __call__(self, op, path, *args):
+        if path is not None and (path == self.virtual_dir or path.startswith(self.virtual_dir + '/')) and op not in self.virtual_ops:
+            raise FuseOSError(EACCES)
+        # readdir is timed and traced up to handing back its generator only
+        started = time.time()
+        result = error = None
+        try:
+            result = Operations.__call__(self, op, path, *args)
+            return result
+        except OSError, e:
+            error = e.errno
+            raise
+        except Exception:
+            error = EIO
+            raise
+        finally:
+            seconds = time.time() - started
+            self.metrics.observe('ops', op, seconds, error is not None)
+            if self.tracer.enabled:
+                self.tracer.record(op, path, args, result, error, seconds)
+
+    def stats_text(self):
+        return json.dumps(self.metrics.snapshot(), indent=2, sort_keys=True) + '\n'
+
+    def trace_text(self):
+        return '# ' + self.tracer.status() + '\n' + self.tracer.text()
+
+    def trace_control(self, text):
+        self.tracer.configure(text)
+
+    def virtual_name(self, path):
+        """Returns the name of the virtual file at path, or None."""
+        if os.path.dirname(path) == self.virtual_dir and os.path.basename(path) in self.virtual_files:
+            return os.path.basename(path)
+        return None
+
+    def virtual_render(self, name, max_age=0):
+        """Returns the contents of a virtual file, rendered anew unless the
+           last rendering is at most max_age seconds old. open reuses what
+           getattr rendered just before, so the size the kernel was told
+           matches the data it reads."""
+        cached = self.virtual_cache.get(name)
+        if cached is None or cached[0] + max_age < time.time():
+            cached = self.virtual_cache[name] = (time.time(), self.virtual_files[name]())
+        return cached[1]
 
-        f = tempfile.NamedTemporaryFile(delete=False)
-        f.write(raw)
-        self.files[path] = {'object': f, 'modified': False}
+    def file_rename(self, old, new):
+        with self.files_lock:
+            if old in self.files:
+                self.files[new] = self.files.pop(old)
+                self.files[new]['path'] = new
+
+    def negative_hit(self, path):
+        """Tells whether path, or its parent, recently turned out not to
+           exist."""
+        now = time.time()
+        with self.negative_lock:
+            for probe in (path, os.path.dirname(path)):
+                expire = self.negative.get(probe)
+                if expire is not None:
+                    if expire >= now:
+                        self.metrics.count('negative_cache_hits')
+                        return True
+                    del self.negative[probe]
+        return False
+
+    def negative_add(self, path):
+        with self.negative_lock:
+            self.negative.pop(path, None)
+            self.negative[path] = time.time() + self.negative_timeout
+            while len(self.negative) > self.negative_size:
+                self.negative.popitem(last=False)
+
+    def negative_clear(self, path):
+        """Forgets the misses for path and everything below it."""
+        with self.negative_lock:
+            self.negative.pop(path, None)
+            prefix = path.rstrip('/') + '/'
+            for probe in [probe for probe in self.negative if probe.startswith(prefix)]:
+                del self.negative[probe]
+
+    def file_get(self, path, download=True, ref=False):
+        """Returns the staging copy of path, setting it up on first use.
+           Threads asking for a copy that is still being set up wait for it
+           instead of downloading the file again. With ref, the copy counts
+           one more user and stays until file_release."""
+        with self.files_lock:
+            fileObject = self.files.get(path)
+            creating = fileObject is None
+            if creating:
+                # parts are the remote parts of the file by offset, present
+                # the ones already in the staging file and dirty the
+                # (start, end) ranges written since the last upload; a file
+                # not downloaded is new and modified until its first upload
+                fileObject = self.files[path] = {'path': path, 'object': None, 'ready': Event(), 'failed': False, 'refs': 0, 'rwlock': RWLock(),
+                                                 'modified': not download, 'parts': [], 'offsets': [], 'present': set(), 'pending': {}, 'lock': Lock(),
+                                                 'read_end': 0, 'window': 0, 'prefetched': 0, 'generation': 0, 'dirty': [], 'mtime': None}
+            if ref:
+                fileObject['refs'] += 1
+
+        if not creating:
+            fileObject['ready'].wait()
+            if fileObject['failed']:
+                if ref:
+                    with self.files_lock:
+                        fileObject['refs'] -= 1
+                raise FuseOSError(EIO)
+            return fileObject
+
+        f = self.staging.create()
+        try:
+            parts = None
+            if download == True:
+                parts = self.copy_api.object_parts(path)
+                if parts is None:
+                    f.fill(0, self.copy_api.download_object(path))
+                elif parts:
+                    # sparse copy, filled part by part as it is read
+                    f.truncate(parts[-1]['offset'] + parts[-1]['size'])
+        except:
+            f.close()
+            with self.files_lock:
+                if self.files.get(fileObject['path']) is fileObject:
+                    del self.files[fileObject['path']]
+            fileObject['failed'] = True
+            fileObject['ready'].set()
+            raise
 
         # print "opening: " + path
 
-        return self.files[path]
+        fileObject['object'] = f
+        fileObject['parts'] = parts or []
+        fileObject['offsets'] = [part['offset'] for part in parts or []]
+        fileObject['ready'].set()
+        return fileObject
+
+    def file_handle(self, path, fh):
+        """Returns the staging copy behind an open handle."""
+        handle = self.handles.get(fh)
+        if handle is not None:
+            return handle['file']
+        return self.file_get(path)
+
+    def file_open(self, path, flags, download=True):
+        return self.handle_open({'file': self.file_get(path, download, ref=True), 'flags': flags})
+
+    def handle_open(self, handle):
+        with self.files_lock:
+            fh = self.next_fh
+            self.next_fh += 1
+            self.handles[fh] = handle
+        return fh
+
+    def file_release(self, fileObject):
+        """Drops one user of a staging copy and closes it after the last
+           one, once its changes are uploaded."""
+        with self.files_lock:
+            fileObject['refs'] -= 1
+            if fileObject['refs'] > 0:
+                return
+        if self.writeback is not None and fileObject['modified'] == True:
+            # keep the staging copy until the queued upload is done
+            self.writeback.add(fileObject['path'])
+        else:
+            self.file_close(fileObject['path'])
+
+    def file_fill(self, fileObject, offset, length, skip_covered=False, generation=None):
+        """Makes sure the remote parts overlapping [offset, offset + length)
+           are in the staging file. With skip_covered, parts lying entirely
+           inside the range are only marked present, for writes that are
+           about to overwrite them. Parts already being fetched by another
+           thread are waited for instead of fetched twice. A prefetch passes
+           the generation it was scheduled in and stops once it is stale."""
+        pending = fileObject['pending']
+        end = offset + length
+        while True:
+            claimed = []
+            waiting = []
+            with fileObject['lock']:
+                if generation is not None and generation != fileObject['generation']:
+                    return
+                # an upload replaces the part list, so always use the latest
+                parts = fileObject['parts']
+                present = fileObject['present']
+                first = max(bisect_right(fileObject['offsets'], offset) - 1, 0)
+                for i in range(first, len(parts)):
+                    part = parts[i]
+                    if part['offset'] >= end:
+                        break
+                    if i in present or part['offset'] + part['size'] <= offset:
+                        continue
+                    if i in pending:
+                        waiting.append(pending[i])
+                    elif skip_covered and part['offset'] >= offset and part['offset'] + part['size'] <= end:
+                        present.add(i)
+                    else:
+                        pending[i] = Event()
+                        claimed.append((i, part, pending[i]))
+            if not claimed and not waiting:
+                return
+
+            try:
+                for i in range(0, len(claimed), self.copy_api.batch_parts):
+                    batch = claimed[i:i + self.copy_api.batch_parts]
+                    if generation is not None and generation != fileObject['generation']:
+                        break
+                    datas = self.copy_api.get_parts([claimed_part for _, claimed_part, _ in batch])
+                    with fileObject['lock']:
+                        f = fileObject['object']
+                        parts = fileObject['parts']
+                        present = fileObject['present']
+                        for (index, part, event), data in zip(batch, datas):
+                            # the file may have been truncated or closed meanwhile
+                            if not f.closed and index < len(parts) and parts[index] is part and index not in present:
+                                f.fill(part['offset'], data)
+                                present.add(index)
+                            if pending.get(index) is event:
+                                del pending[index]
+                            event.set()
+                        if not f.closed and self.staging.over_budget():
+                            self.file_evict(fileObject, offset, end)
+            finally:
+                with fileObject['lock']:
+                    for index, part, event in claimed:
+                        if pending.get(index) is event:
+                            del pending[index]
+                        event.set()
+
+            if generation is not None:
+                return
+            # another thread may have failed to fetch what we waited for,
+            # so go round again until everything is present
+            for event in waiting:
+                event.wait()
+
+    def file_evict(self, fileObject, offset, end):
+        """Drops clean parts outside [offset, end) from the staging file,
+           lowest first, until the staging store is back within its budget.
+           They are fetched again when they are read. Called with the file's
+           lock held."""
+        f = fileObject['object']
+        parts = fileObject['parts']
+        present = fileObject['present']
+        for i in sorted(present):
+            if not self.staging.over_budget():
+                return
+            start = parts[i]['offset']
+            stop = start + parts[i]['size']
+            # written since the last upload, cut by a truncate or wanted now
+            if range_uncovered(f.filled, start, stop) or (start < end and stop > offset):
+                continue
+            f.evict(start, parts[i]['size'])
+            present.discard(i)
+
+    def file_present(self, fileObject, offset, size):
+        """Tells whether the parts overlapping [offset, offset + size) are
+           all in the staging file. Called with the file's lock held."""
+        parts = fileObject['parts']
+        end = offset + size
+        for i in range(max(bisect_right(fileObject['offsets'], offset) - 1, 0), len(parts)):
+            if parts[i]['offset'] >= end:
+                break
+            if i not in fileObject['present'] and parts[i]['offset'] + parts[i]['size'] > offset:
+                return False
+        return True
+
+    def file_readahead(self, fileObject, offset, size):
+        """Prefetches the parts following a read in the background while
+           reads of the file stay sequential, doubling the window each time
+           it is extended. A read far from where the others ended cancels
+           prefetches that have not started yet."""
+        if self.prefetch_pool is None or self.readahead <= 0 or not fileObject['parts']:
+            return
+        end = offset + size
+        with fileObject['lock']:
+            # the kernel has several reads of a file in flight and they may
+            # be handled out of order, so one near the end of the others
+            # still counts as sequential
+            slack = max(fileObject['window'], 2 * PART_SIZE)
+            if abs(offset - fileObject['read_end']) > slack:
+                fileObject['generation'] += 1
+                fileObject['window'] = 0
+                fileObject['prefetched'] = 0
+                fileObject['read_end'] = end
+                self.metrics.count('readahead_resets')
+                return
+            end = fileObject['read_end'] = max(fileObject['read_end'], end)
+            # still far enough ahead of the reader
+            if fileObject['prefetched'] - end > fileObject['window'] // 2:
+                return
+            fileObject['window'] = min(max(fileObject['window'] * 2, 2 * PART_SIZE), self.readahead)
+            if self.staging.budget:
+                # prefetching more than fits would only evict what it fetched
+                fileObject['window'] = min(fileObject['window'], self.staging.budget // 2)
+            start = max(end, fileObject['prefetched'])
+            stop = end + fileObject['window']
+            last = fileObject['parts'][-1]
+            stop = min(stop, last['offset'] + last['size'])
+            if start >= stop:
+                return
+            fileObject['prefetched'] = stop
+            generation = fileObject['generation']
+        self.metrics.count('readahead_prefetches')
+        self.prefetch_pool.apply_async(self.file_fill, (fileObject, start, stop - start), {'generation': generation})
+
+    def file_writeback(self, path):
+        """Uploads a file queued for write-back and closes its staging copy
+           if it was released meanwhile."""
+        fileObject = self.files.get(path)
+        if fileObject is None:
+            return
+        self.file_upload(path)
+        if fileObject['refs'] == 0 and fileObject['modified'] == False:
+            self.file_close(path)
+
+    def file_layout(self, fileObject, size, dirty):
+        """Returns what to upload for a file of the given size: the remote
+           parts that no dirty range touches, which are reused as they are,
+           and in between them spans without a fingerprint covering the
+           changed parts and the data past the remote parts, which the
+           upload cuts into new parts."""
+        layout = []
+        offset = 0
+        for part in fileObject['parts']:
+            if part['offset'] >= size:
+                break
+            end = part['offset'] + part['size']
+            if end > size or range_overlaps(dirty, part['offset'], end):
+                if layout and layout[-1]['fingerprint'] is None:
+                    layout[-1]['size'] = min(end, size) - layout[-1]['offset']
+                else:
+                    layout.append({'fingerprint': None, 'offset': part['offset'], 'size': min(end, size) - part['offset']})
+            else:
+                layout.append(part)
+            offset = min(end, size)
+        if offset < size:
+            if layout and layout[-1]['fingerprint'] is None:
+                layout[-1]['size'] = size - layout[-1]['offset']
+            else:
+                layout.append({'fingerprint': None, 'offset': offset, 'size': size - offset})
+        return layout
 
     def file_close(self, path):
-        if path in self.files:
-            if self.files[path]['modified'] == True:
-                self.file_upload(path)
-
-            # print "closing: " + path
-
-            self.files[path]['object'].close()
-            del self.files[path]
+        fileObject = self.files.get(path)
+        if fileObject is None:
+            return
+        if fileObject['modified'] == True:
+            self.file_upload(path)
+
+        with self.files_lock:
+            # opened again meanwhile
+            if fileObject['refs'] > 0 or self.files.get(fileObject['path']) is not fileObject:
+                return
+            del self.files[fileObject['path']]
+
+        # print "closing: " + path
+
+        with fileObject['rwlock'].writing():
+            with fileObject['lock']:
+                # cancel outstanding prefetches
+                fileObject['generation'] += 1
+                fileObject['object'].close()
 
     def file_upload(self, path):
-        if path not in self.files:
+        fileObject = self.files.get(path)
+        if fileObject is None:
             raise FuseOSError(EIO)
 
-        fileObject = self.file_get(path)
+        # writes wait until the upload has read the staging file
+        with fileObject['rwlock'].reading():
+            return self.file_upload_locked(fileObject)
+
+    def file_upload_locked(self, fileObject):
         if fileObject['modified'] == False:
             return True
+        path = fileObject['path']
 
         # print 'uploading: ' + path
 
         f = fileObject['object']
 
-        # obtain the size of the file
-        f.seek(0, os.SEEK_END)
-        size = f.tell()
-        f.seek(0)
-
-        parts = self.copy_api.partify(f, size)
-
-        # obtain list of parts that need to be sent
-        response = self.copy_api.part_request('has_parts', parts)
-
-        if 'send_parts' not in response:
-            raise FuseOSError(EIO)
-
-        # build array of parts that need to be sent
-        need_parts = {}
-        for need_part in response['send_parts']:
-            need_parts[need_part['fingerprint'] + '-' + need_part['size']] = True
-
-        # send the missing parts
-        send_parts = {}
-        for i in range(0, len(parts)):
-            if parts[i]['fingerprint'] + '-' + str(parts[i]['size']) in need_parts:
-                send_parts[len(send_parts)] = parts[i]
-        response = self.copy_api.part_request('send_parts', send_parts)
-
-        # trap any errors
-        if (response == False or response['result'] != 'success'):
-            raise FuseOSError(EIO)
-
-        # remove data from parts (already sent)
-        for i in range(0, len(parts)):
-            del parts[i]['data']
-
-        # send file metadata
-        params = {'meta': {}}
-        params['meta'][0] = {'action': 'create', 'object_type': 'file', 'path': path, 'size': size, 'parts': parts}
-        response = self.copy_api.copyrequest('/update_objects', params, True)
-
-        # trap any errors
-        if response['result'] != 'success':
-            raise FuseOSError(EIO)
-
-        fileObject['modified'] = False
+        with fileObject['lock']:
+            # writes from here on mark the file modified again
+            fileObject['modified'] = False
+            dirty = fileObject['dirty']
+            fileObject['dirty'] = []
+
+            # obtain the size of the file
+            size = f.size
+
+            layout = self.file_layout(fileObject, size, dirty)
+
+        try:
+            # the changed parts have to be local, the others are reused
+            for part in layout:
+                if part['fingerprint'] is None:
+                    self.file_fill(fileObject, part['offset'], part['size'])
+
+            # the upload reads the staging file through its own handles
+            parts = self.copy_api.upload(f.name, layout)
+            layout = [parts[i] for i in range(len(parts))]
+
+            # send file metadata
+            self.copy_api.update_object({'action': 'create', 'object_type': 'file', 'path': path, 'size': size, 'parts': parts})
+            self.copy_api.apply_local(path, self.local_child(path, 'file', size))
+        except:
+            with fileObject['lock']:
+                fileObject['modified'] = True
+                for start, end in dirty:
+                    mark_range(fileObject['dirty'], start, end)
+            raise
+
+        with fileObject['lock']:
+            # the uploaded parts are what later uploads compare against;
+            # the ones hashed just now are local, the reused ones are local
+            # if they were before
+            old_parts = set(id(part) for part in fileObject['parts'])
+            present = set(id(fileObject['parts'][i]) for i in fileObject['present'])
+            size = f.size
+            layout = [part for part in layout if part['offset'] < size]
+            fileObject['parts'] = layout
+            fileObject['offsets'] = [part['offset'] for part in layout]
+            fileObject['present'] = set(i for i, part in enumerate(layout) if id(part) not in old_parts or id(part) in present)
+            # what is local now matches the server and can be evicted
+            f.clean([(layout[i]['offset'], layout[i]['offset'] + layout[i]['size']) for i in sorted(fileObject['present'])])
+
+    def init(self, path):
+        self.copy_api.start()
+        self.prefetch_pool = ThreadPool(self.copy_api.data_connections)
+        if self.writeback is not None:
+            self.writeback.start()
+
+    def destroy(self, path):
+        if self.writeback is not None:
+            self.writeback.stop()
+        if self.prefetch_pool is not None:
+            self.prefetch_pool.terminate()
+            self.prefetch_pool = None
+        self.copy_api.stop()
+        self.staging.close()
 
     def chmod(self, path, mode):
         return 0
@@ -224,110 +2165,275 @@ class CopyFUSE(LoggingMixIn, Operations):
 
     def getattr(self, path, fh=None):
         # print "getattr: " + path
-        if path == '/':
+        if path == '/' or path == self.virtual_dir:
             st = dict(st_mode=(S_IFDIR | 0755), st_nlink=2)
             st['st_ctime'] = st['st_atime'] = st['st_mtime'] = time.time()
+        elif self.virtual_name(path) is not None:
+            name = self.virtual_name(path)
+            st = dict(st_mode=(S_IFREG | (0644 if name in self.virtual_controls else 0444)), st_size=len(self.virtual_render(name)))
+            st['st_ctime'] = st['st_atime'] = st['st_mtime'] = time.time()
+        elif path.startswith(self.virtual_dir + '/'):
+            raise FuseOSError(ENOENT)
         else:
+            if self.negative_hit(path):
+                raise FuseOSError(ENOENT)
+
             name = str(os.path.basename(path))
             objects = self.copy_api.list_objects(os.path.dirname(path))
-
-            if name not in objects:
-                raise FuseOSError(ENOENT)
-            elif objects[name]['type'] == 'file':
-                st = dict(st_mode=(S_IFREG | 0644), st_size=int(objects[name]['size']))
+            fileObject = self.files.get(path)
+
+            if name in objects:
+                st = self.object_attrs(objects[name])
+            elif fileObject is not None:
+                # created here and not uploaded yet
+                st = dict(st_mode=(S_IFREG | 0644))
+                st['st_ctime'] = st['st_atime'] = st['st_mtime'] = time.time()
             else:
-                st = dict(st_mode=(S_IFDIR | 0755), st_nlink=2)
+                self.negative_add(path)
+                raise FuseOSError(ENOENT)
+
+            # an open file's local copy is ahead of the listing
+            if fileObject is not None and fileObject['object'] is not None:
+                st['st_size'] = fileObject['object'].size
+                if fileObject['mtime'] is not None:
+                    st['st_mtime'] = fileObject['mtime']
+        return st
+
+    def cached_child(self, path):
+        """Returns the cached listing entry of path, or None."""
+        listing = self.copy_api.tree_children.get(os.path.dirname(path))
+        if listing is None:
+            return None
+        return listing.get(str(os.path.basename(path)))
+
+    def local_child(self, path, type, size=0):
+        """Returns the listing entry of path after a change made here."""
+        now = time.time()
+        old = self.cached_child(path)
+        return CopyObject(str(os.path.basename(path)), type, size, old.ctime if old is not None else now, now)
+
+    def object_attrs(self, child):
+        if child.type == 'file':
+            st = dict(st_mode=(S_IFREG | 0644), st_size=child.size)
+        else:
+            st = dict(st_mode=(S_IFDIR | 0755), st_nlink=2)
 
-            st['st_ctime'] = st['st_atime'] = objects[name]['ctime']
-            st['st_mtime'] = objects[name]['mtime']
+        st['st_ctime'] = st['st_atime'] = child.ctime
+        st['st_mtime'] = child.mtime
         return st
 
     def mkdir(self, path, mode):
         # print "mkdir: " + path
         # send file metadata
-        params = {'meta': {}}
-        params['meta'][0] = {'action': 'create', 'object_type': 'dir', 'path': path}
-        response = self.copy_api.copyrequest('/update_objects', params, True)
+        self.copy_api.update_object({'action': 'create', 'object_type': 'dir', 'path': path})
+        self.copy_api.apply_local(path, self.local_child(path, 'dir'))
 
-        # trap any errors
-        if response['result'] != 'success':
-            raise FuseOSError(EIO)
+        self.negative_clear(path)
 
     def open(self, path, flags):
         # print "open: " + path
-        self.file_get(path)
-        return 0
+        name = self.virtual_name(path)
+        if name is not None:
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                if name not in self.virtual_controls:
+                    raise FuseOSError(EACCES)
+                return self.handle_open({'file': None, 'data': '', 'control': self.virtual_controls[name]})
+            return self.handle_open({'file': None, 'data': self.virtual_render(name, 1)})
+        return self.file_open(path, flags)
 
     def flush(self, path, fh):
         # print "flush: " + path
         if path in self.files:
-            if self.files[path]['modified'] == True:
-                self.file_upload(path)
+            if self.file_handle(path, fh)['modified'] == True:
+                if self.writeback is not None:
+                    self.writeback.add(path)
+                else:
+                    self.file_upload(path)
 
     def fsync(self, path, datasync, fh):
         # print "fsync: " + path
         if path in self.files:
-            if self.files[path]['modified'] == True:
+            # the only call that waits for the data to be stored remotely
+            if self.writeback is not None:
+                self.writeback.wait(path)
+            if self.file_handle(path, fh)['modified'] == True:
                 self.file_upload(path)
 
     def release(self, path, fh):
         # print "release: " + path
-        self.file_close(path)
+        with self.files_lock:
+            handle = self.handles.pop(fh, None)
+        if handle is not None:
+            if handle['file'] is not None:
+                self.file_release(handle['file'])
+        elif path in self.files and self.files[path]['refs'] == 0:
+            self.file_close(path)
 
     def read(self, path, size, offset, fh):
-        f = self.file_get(path)['object']
-        f.seek(offset)
-        return f.read(size)
-
-    def readdir(self, path, fh):
+        handle = self.handles.get(fh)
+        if handle is not None and handle['file'] is None:
+            return handle['data'][offset:offset + size]
+        fileObject = self.file_handle(path, fh)
+        self.file_readahead(fileObject, offset, size)
+        with fileObject['rwlock'].reading():
+            while True:
+                self.file_fill(fileObject, offset, size)
+                with fileObject['lock']:
+                    # another read may have evicted the parts meanwhile
+                    if self.file_present(fileObject, offset, size):
+                        return fileObject['object'].read(offset, size)
+
+    def read_buf(self, path, buf, size, offset, fh):
+        # reads from the staging file straight into the kernel's buffer
+        handle = self.handles.get(fh)
+        if handle is not None and handle['file'] is None:
+            data = handle['data'][offset:offset + size]
+            memmove(buf, data, len(data))
+            return len(data)
+        fileObject = self.file_handle(path, fh)
+        self.file_readahead(fileObject, offset, size)
+        with fileObject['rwlock'].reading():
+            while True:
+                self.file_fill(fileObject, offset, size)
+                with fileObject['lock']:
+                    if self.file_present(fileObject, offset, size):
+                        return fileObject['object'].readinto(buf, size, offset)
+
+    def readdir(self, path, fh, offset=0):
         # print "readdir: " + path
-        objects = self.copy_api.list_objects(path)
-
-        listing = ['.', '..']
-        for child in objects:
-            listing.append(child)
-        return listing
+        # entries come with their attributes and with offsets that follow
+        # the server's order, so the kernel can resume a large directory
+        # where its buffer filled up
+        if offset < 1:
+            yield '.', None, 1
+        if offset < 2:
+            yield '..', None, 2
+        if path == self.virtual_dir:
+            names = sorted(self.virtual_files)
+            for position in range(max(offset, 2), len(names) + 2):
+                yield names[position - 2], None, position + 1
+            return
+        for position, name, child in self.copy_api.iter_objects(path, max(offset, 2) - 2):
+            yield name, self.object_attrs(child), position + 3
 
     def rename(self, old, new):
         # print "renaming: " + old + " to " + new
+        fileObject = self.files.get(old)
+        if fileObject is not None:
+            # the file has to exist remotely under its old name first
+            if self.writeback is not None:
+                self.writeback.wait(old)
+            self.file_upload(old)
+        child = self.cached_child(old)
+        self.copy_api.update_object({'action': 'rename', 'path': old, 'new_path': new})
         self.file_rename(old, new)
-        params = {'meta': {}}
-        params['meta'][0] = {'action': 'rename', 'path': old, 'new_path': new}
-        self.copy_api.copyrequest("/update_objects", params, False)
+        self.copy_api.apply_local(old, None)
+        if child is not None:
+            self.copy_api.apply_local(new, CopyObject(str(os.path.basename(new)), child.type, child.size, child.ctime, time.time()))
+        else:
+            # not known what moved, so list the target directory again
+            self.copy_api.tree_children.pop(os.path.dirname(new))
+        if child is None or child.type == 'dir':
+            # the listings under new may be those of a directory it replaced
+            for moved in (old, new):
+                self.copy_api.tree_children.discard_tree(moved)
+                if self.copy_api.metadata_store is not None:
+                    self.copy_api.metadata_store.discard(moved)
+        self.negative_clear(new)
+        if fileObject is not None and fileObject['refs'] == 0 and fileObject['modified'] == False:
+            # released already and only kept for the write-back taken off
+            # the queue above
+            self.file_close(new)
 
     def create(self, path, mode):
         # print "create: " + path
-        name = os.path.basename(path)
-        if os.path.dirname(path) in self.copy_api.tree_children:
-            self.copy_api.tree_children[os.path.dirname(path)][name] = {'name': name, 'type': 'file', 'size': 0, 'ctime': time.time(), 'mtime': time.time()}
-        self.file_get(path, download=False)
-        self.file_upload(path)
-        return 0
+        self.negative_clear(path)
+        self.copy_api.apply_local(path, self.local_child(path, 'file'))
+        return self.file_open(path, os.O_CREAT | os.O_WRONLY, download=False)
 
     def truncate(self, path, length, fh=None):
         # print "truncate: " + path
-        f = self.file_get(path)['object']
-        f.truncate(length)
+        if self.virtual_name(path) is not None:
+            # opening a control file for writing may truncate it first
+            return
+        if fh is None:
+            # truncate without an open handle, store the result right away
+            fh = self.file_open(path, os.O_WRONLY)
+            try:
+                self.truncate(path, length, fh)
+            finally:
+                self.release(path, fh)
+            return
+
+        fileObject = self.file_handle(path, fh)
+        with fileObject['rwlock'].writing():
+            # keep the part the new end falls in, forget the ones past it;
+            # an end on a part boundary keeps whole parts only
+            with fileObject['lock']:
+                i = bisect_right(fileObject['offsets'], length) - 1
+                part = fileObject['parts'][i] if i >= 0 else None
+            if part is not None and part['offset'] < length < part['offset'] + part['size']:
+                self.file_fill(fileObject, length, 1)
+            with fileObject['lock']:
+                while fileObject['parts'] and fileObject['parts'][-1]['offset'] >= length:
+                    fileObject['parts'].pop()
+                    fileObject['offsets'].pop()
+                fileObject['present'].intersection_update(range(len(fileObject['parts'])))
+                fileObject['object'].truncate(length)
+                fileObject['modified'] = True
+                fileObject['mtime'] = time.time()
+                # the part the new end falls in has changed, even if the
+                # file grows again later
+                mark_range(fileObject['dirty'], length, length + 1)
 
     def unlink(self, path):
         # print "unlink: " + path
-        params = {'meta': {}}
-        params['meta'][0] = {'action': 'remove', 'path': path}
-        self.copy_api.copyrequest("/update_objects", params, False)
+        if self.writeback is not None and path in self.files:
+            self.writeback.wait(path)
+            fileObject = self.files.get(path)
+            if fileObject is not None and fileObject['refs'] == 0:
+                fileObject['modified'] = False
+                self.file_close(path)
+        self.copy_api.update_object({'action': 'remove', 'path': path})
+        self.copy_api.apply_local(path, None)
 
     def rmdir(self, path):
-        params = {'meta': {}}
-        params['meta'][0] = {'action': 'remove', 'path': path}
-        self.copy_api.copyrequest("/update_objects", params, False)
+        self.copy_api.update_object({'action': 'remove', 'path': path})
+        self.copy_api.apply_local(path, None)
+        self.copy_api.tree_children.discard_tree(path)
 
     def write(self, path, data, offset, fh):
-        fileObject = self.file_get(path)
-        f = fileObject['object']
-        f.seek(offset)
-        f.write(data)
-        fileObject['modified'] = True
+        handle = self.handles.get(fh)
+        if handle is not None and handle['file'] is None:
+            if 'control' not in handle:
+                raise FuseOSError(EACCES)
+            handle['control'](data)
+            return len(data)
+        fileObject = self.file_handle(path, fh)
+        with fileObject['rwlock'].writing():
+            self.file_fill(fileObject, offset, len(data), skip_covered=True)
+            with fileObject['lock']:
+                fileObject['object'].write(offset, data)
+                fileObject['modified'] = True
+                fileObject['mtime'] = time.time()
+                mark_range(fileObject['dirty'], offset, offset + len(data))
         return len(data)
 
+    def write_buf(self, path, buf, size, offset, fh):
+        # writes the kernel's buffer straight into the staging file
+        handle = self.handles.get(fh)
+        if handle is not None and handle['file'] is None:
+            return self.write(path, string_at(buf, size), offset, fh)
+        fileObject = self.file_handle(path, fh)
+        with fileObject['rwlock'].writing():
+            self.file_fill(fileObject, offset, size, skip_covered=True)
+            with fileObject['lock']:
+                fileObject['object'].write_from(buf, size, offset)
+                fileObject['modified'] = True
+                fileObject['mtime'] = time.time()
+                mark_range(fileObject['dirty'], offset, offset + size)
+        return size
+
     # Disable unused operations:
     access = None
     getxattr = None
@@ -351,6 +2457,79 @@ def main():
     parser.add_argument(
         '-o', '--options', help='add extra fuse options (see "man fuse")')
     
+    parser.add_argument(
+        '--api-url', default=API_URL,
+        help='base URL of the Copy API (default: %(default)s)')
+    parser.add_argument(
+        '--meta-connections', type=int, default=4,
+        help='size of the connection pool used for metadata requests')
+    parser.add_argument(
+        '--data-connections', type=int, default=4,
+        help='size of the connection pool used for downloads and uploads')
+    parser.add_argument(
+        '--cache-dir', default=os.path.expanduser('~/.cache/copyfuse/blocks'),
+        help='directory of the persistent block cache')
+    parser.add_argument(
+        '--cache-size', type=int, default=1024,
+        help='size budget of the block cache in MiB (0 disables it)')
+    parser.add_argument(
+        '--readahead', type=int, default=32,
+        help='maximum sequential read-ahead window in MiB (0 disables it)')
+    parser.add_argument(
+        '--metadata-db',
+        help='sqlite file keeping directory listings across mounts (default: ~/.cache/copyfuse/EMAIL.db, "none" disables it)')
+    parser.add_argument(
+        '--negative-timeout', type=float, default=10,
+        help='seconds a missing path is remembered, both here and by the kernel')
+    parser.add_argument(
+        '--listing-ttl', type=float, default=10,
+        help='seconds a directory listing is used before it is fetched again')
+    parser.add_argument(
+        '--serve-stale', type=float, default=0,
+        help='seconds an expired listing is still answered from while it is fetched again in the background (0 waits for the fetch)')
+    parser.add_argument(
+        '--hot-refresh', type=int, default=20,
+        help='lookups within one TTL after which a listing is refreshed before it expires (0 disables it)')
+    parser.add_argument(
+        '--max-cached-entries', type=int, default=1000000,
+        help='directory entries kept in memory before whole listings are evicted')
+    parser.add_argument(
+        '--writeback', default=False, action='store_true',
+        help='upload closed and flushed files in the background; only fsync waits for the upload')
+    parser.add_argument(
+        '--writeback-delay', type=float, default=2,
+        help='seconds a dirty file waits for further changes before it is uploaded')
+    parser.add_argument(
+        '--writeback-workers', type=int, default=2,
+        help='maximum number of background uploads at once')
+    parser.add_argument(
+        '--chunking', choices=('fixed', 'cdc'), default='fixed',
+        help='cut uploads into fixed 1 MiB parts or into content-defined parts (slower, better deduplication of inserts)')
+    parser.add_argument(
+        '--chunk-sizes', default='256,1024,4096', metavar='MIN,AVG,MAX',
+        help='minimum, average and maximum part size in KiB for --chunking=cdc')
+    parser.add_argument(
+        '--staging-dir', default=os.path.expanduser('~/.cache/copyfuse/staging'),
+        help='directory of the local copies of open files, shared by all mounts')
+    parser.add_argument(
+        '--staging-size', type=int, default=4096,
+        help='most MiB of unsaved changes held in local copies of open files, and past which fetched parts are evicted (0 for no limit)')
+    parser.add_argument(
+        '--trace', default=False, action='store_true',
+        help='record operations from the start; read or write commands to /.copyfuse/trace to control tracing at run time')
+    parser.add_argument(
+        '--trace-size', type=int, default=10000,
+        help='most recent operations kept by the trace')
+    parser.add_argument(
+        '--trace-sample', type=int, default=1,
+        help='trace one in every N operations')
+    parser.add_argument(
+        '--trace-ops', metavar='OP,OP',
+        help='only trace these operations (default: all)')
+    parser.add_argument(
+        '--max-write', type=int, default=128,
+        help='largest write the kernel passes down at once in KiB (Linux, enables big_writes)')
+    
     parser.add_argument(
         'username', metavar='EMAIL', help='username/email')
     parser.add_argument(
@@ -363,20 +2542,60 @@ def main():
     username = args.__dict__.pop('username')
     password = args.__dict__.pop('password')
     mount_point = args.__dict__.pop('mount_point')
+    api_url = args.__dict__.pop('api_url')
+    meta_connections = args.__dict__.pop('meta_connections')
+    data_connections = args.__dict__.pop('data_connections')
+    cache_dir = args.__dict__.pop('cache_dir')
+    cache_size = args.__dict__.pop('cache_size') * 1048576
+    readahead = args.__dict__.pop('readahead') * 1048576
+    metadata_db = args.__dict__.pop('metadata_db')
+    negative_timeout = args.__dict__.pop('negative_timeout')
+    max_cached_entries = args.__dict__.pop('max_cached_entries')
+    listing_ttl = args.__dict__.pop('listing_ttl')
+    stale_ttl = args.__dict__.pop('serve_stale')
+    hot_hits = args.__dict__.pop('hot_refresh')
+    writeback = args.__dict__.pop('writeback')
+    writeback_delay = args.__dict__.pop('writeback_delay')
+    writeback_workers = args.__dict__.pop('writeback_workers')
+    chunking = args.__dict__.pop('chunking')
+    max_write = args.__dict__.pop('max_write') * 1024
+    staging_dir = args.__dict__.pop('staging_dir')
+    trace = args.__dict__.pop('trace')
+    trace_size = args.__dict__.pop('trace_size')
+    trace_sample = args.__dict__.pop('trace_sample')
+    trace_ops = args.__dict__.pop('trace_ops')
+    staging_size = args.__dict__.pop('staging_size') * 1048576
+    chunk_sizes = [int(size) * 1024 for size in args.__dict__.pop('chunk_sizes').split(',')]
+    if chunking == 'cdc':
+        chunker = ContentChunker(*chunk_sizes)
+    else:
+        chunker = FixedChunker()
+    if metadata_db is None:
+        metadata_db = os.path.expanduser(os.path.join('~/.cache/copyfuse', username + '.db'))
+    elif metadata_db == 'none':
+        metadata_db = None
     
     # parse options
     options_str = args.__dict__.pop('options')
     options = dict([(kv.split('=', 1)+[True])[:2] for kv in (options_str and options_str.split(',')) or []])
     
     fuse_args = args.__dict__.copy()
+    # let the kernel cache misses as long as we do; as a string, since FUSE
+    # passes any value equal to True as a bare flag, 1 included
+    fuse_args['negative_timeout'] = str(negative_timeout)
+    if system() == 'Linux':
+        # without big_writes the kernel splits writes into 4 KiB pages
+        fuse_args['big_writes'] = True
+        fuse_args['max_write'] = max_write
     fuse_args.update(options)
     
     logfile = None
     if fuse_args.get('debug', False) == True:
         # send to stderr same as where fuse lib sends debug messages
         logfile = stderr
+    tracer = Tracer(trace_size, trace or logfile is not None, max(trace_sample, 1), trace_ops and frozenset(trace_ops.split(',')), logfile)
     
-    fuse = FUSE(CopyFUSE(username, password, logfile=logfile), mount_point, **fuse_args)
+    fuse = FUSE(CopyFUSE(username, password, logfile=logfile, meta_connections=meta_connections, data_connections=data_connections, cache_dir=cache_dir, cache_size=cache_size, readahead=readahead, metadata_db=metadata_db, negative_timeout=negative_timeout, max_cached_entries=max_cached_entries, writeback=writeback, writeback_delay=writeback_delay, writeback_workers=writeback_workers, chunker=chunker, staging_dir=staging_dir, staging_size=staging_size, api_url=api_url, tracer=tracer, listing_ttl=listing_ttl, stale_ttl=stale_ttl, hot_hits=hot_hits), mount_point, **fuse_args)
 
 
 if __name__ == "__main__":
@@ -391,16 +391,20 @@ class FUSE(object):
 
     def read(self, path, buf, size, offset, fip):
         fh = fip.contents if self.raw_fi else fip.contents.fh
+        if self.operations.read_buf is not None:
+            return self.operations('read_buf', path, buf, size, offset, fh)
         ret = self.operations('read', path, size, offset, fh)
         if not ret:
             return 0
-        data = create_string_buffer(ret[:size], size)
-        memmove(buf, data, size)
+        size = min(len(ret), size)
+        memmove(buf, ret, size)
         return size
 
     def write(self, path, buf, size, offset, fip):
-        data = string_at(buf, size)
         fh = fip.contents if self.raw_fi else fip.contents.fh
+        if self.operations.write_buf is not None:
+            return self.operations('write_buf', path, buf, size, offset, fh)
+        data = string_at(buf, size)
         return self.operations('write', path, data, offset, fh)
 
     def statfs(self, path, buf):
@@ -457,17 +461,24 @@ class FUSE(object):
 
     def readdir(self, path, buf, filler, offset, fip):
         # Ignore raw_fi
-        for item in self.operations('readdir', path, fip.contents.fh):
+        if self.operations.readdir_offsets:
+            items = self.operations('readdir', path, fip.contents.fh, offset)
+        else:
+            items = self.operations('readdir', path, fip.contents.fh)
+        for item in items:
             if isinstance(item, str):
-                name, st, offset = item, None, 0
+                name, st, item_offset = item, None, 0
             else:
-                name, attrs, offset = item
+                name, attrs, item_offset = item
+                # skip what an earlier call already handed out
+                if item_offset and item_offset <= offset:
+                    continue
                 if attrs:
                     st = c_stat()
                     set_st_attrs(st, attrs)
                 else:
                     st = None
-            if filler(buf, name, st, offset) != 0:
+            if filler(buf, name, st, item_offset) != 0:
                 break
         return 0
 
@@ -616,14 +627,25 @@ class Operations(object):
         return 0
 
     def read(self, path, size, offset, fh):
-        """Returns a string containing the data requested."""
+        """Returns a string containing the data requested.
+           When read_buf is defined it is called instead:
+               read_buf(self, path, buf, size, offset, fh)
+           and copies up to size bytes straight into the ctypes buffer buf,
+           returning the number of bytes copied."""
         raise FuseOSError(EIO)
 
+    read_buf = None
+
     def readdir(self, path, fh):
         """Can return either a list of names, or a list of (name, attrs, offset)
-           tuples. attrs is a dict as in getattr."""
+           tuples. attrs is a dict as in getattr.
+           When readdir_offsets is True the signature becomes:
+               readdir(self, path, fh, offset)
+           and entries up to offset may be left out."""
         return ['.', '..']
 
+    readdir_offsets = False
+
     def readlink(self, path):
         raise FuseOSError(ENOENT)
 
@@ -665,15 +687,22 @@ class Operations(object):
         return 0
 
     def write(self, path, data, offset, fh):
+        """Returns the number of bytes written.
+           When write_buf is defined it is called instead:
+               write_buf(self, path, buf, size, offset, fh)
+           and gets the size bytes to write as a ctypes buffer, valid only
+           for the duration of the call."""
         raise FuseOSError(EROFS)
 
+    write_buf = None
+
 
 class LoggingMixIn:
     logfile = None
     
     def __call__(self, op, path, *args):
         if self.logfile:
-            print '->', op, path, repr(args)
+            print >> self.logfile, '->', op, path, repr(args)
         ret = '[Unhandled Exception]'
         try:
             ret = getattr(self, op)(path, *args)